@@ -8,11 +8,14 @@ import requests
 # Configuração de variáveis e logger
 ORCHEST_STEP_UUID = os.environ.get("ORCHEST_STEP_UUID")
 
+# Timeout (segundos) de conexão e de leitura das requisições
+REQUEST_TIMEOUT = (10, 60)
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-def delete_project(base_url, project_id, auth_token, auth_username, auth_user_uuid):
+def delete_project(base_url, project_id, auth_token, auth_username, auth_user_uuid, session=None):
     """
     Function to delete a project in the Dadosfera Intelligence by API .
 
@@ -22,6 +25,7 @@ def delete_project(base_url, project_id, auth_token, auth_username, auth_user_uu
     auth_token (str): User's authentication token.
     auth_username (str): Username associated with the authentication token.
     auth_user_uuid (str): UUID of the authenticated user.
+    session (requests.Session, optional): Keep-alive session reused across requests. A new one is created if omitted.
 
     Returns:
     str: Success or error message based on the request status.
@@ -36,7 +40,8 @@ def delete_project(base_url, project_id, auth_token, auth_username, auth_user_uu
     }
 
     # Make the DELETE request
-    response = requests.delete(url, headers=headers)
+    session = session or requests.Session()
+    response = session.delete(url, headers=headers, timeout=REQUEST_TIMEOUT)
 
     # Check the response status
     if response.status_code == 200:
@@ -60,12 +65,14 @@ def orchest_handler() -> None:
     if not isinstance(list_project_id, list) or not all(isinstance(item, str) for item in list_project_id):
         raise ValueError("Erro: 'list_project_id' deve ser uma lista de IDs (números ou strings).")
         
+    session = requests.Session()
     for project_id in list_project_id:     
         delete_project(base_url = base_url,
                        project_id = project_id,
                        auth_token = auth_token,
                        auth_username = auth_username,
-                       auth_user_uuid = auth_user_uuid
+                       auth_user_uuid = auth_user_uuid,
+                       session = session
                       )
     
     
@@ -87,12 +94,14 @@ def script_handler() -> None:
     if not isinstance(list_project_id, list) or not all(isinstance(item, str) for item in list_project_id):
         raise ValueError("Erro: 'list_project_id' deve ser uma lista de IDs (números ou strings).")
         
+    session = requests.Session()
     for project_id in list_project_id:     
         delete_project(base_url = base_url,
                        project_id = project_id,
                        auth_token = auth_token,
                        auth_username = auth_username,
-                       auth_user_uuid = auth_user_uuid
+                       auth_user_uuid = auth_user_uuid,
+                       session = session
                       )
                              
 
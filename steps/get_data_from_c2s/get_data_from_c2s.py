@@ -1,13 +1,25 @@
 import os
 import sys
 import json
-import time
 import datetime
+import copy
 import requests
 from typing import List, Dict
 import logging
 import orchest
+from snowflake.snowpark import Window
+from snowflake.snowpark.functions import col, row_number, to_timestamp, when_matched, when_not_matched
 from dadosfera.services.snowflake import get_snowpark_session
+from rest_extraction import (
+    HTTP_POOL_SIZE,
+    PageCheckpoint,
+    RestExtractor,
+    SnowflakeStageWriter,
+    TokenBucket,
+    TotalCountPagination,
+    WatermarkStore,
+    get_http_session,
+)
 
 
 logging.basicConfig(
@@ -22,8 +34,82 @@ logger.setLevel(logging.INFO)
 ORCHEST_STEP_UUID = os.environ.get('ORCHEST_STEP_UUID')
 
 LAST_UPDATE_PATH = "last_update.json"
+CHECKPOINT_PATH = "checkpoint"
 PER_PAGE = 50
+# Largest 'perpage' sent to the API; larger configured values are clamped
+MAX_PER_PAGE = 100
 MAX_REQ_PER_MINUTE = 10
+# Token bucket burst. It is subtracted from the refill rate, so no 60s window
+# goes over MAX_REQ_PER_MINUTE
+BUCKET_CAPACITY = 1
+# Adaptive rate (AIMD): fraction of the max rate added on every success and
+# minimum rate, as a fraction of the max
+AIMD_INCREASE_FRACTION = 0.1
+AIMD_MIN_RATE_FRACTION = 0.1
+# Bulk load: leads per staged Parquet file and the temporary stage used
+LOAD_CHUNK_SIZE = 10000
+SNOWFLAKE_STAGE = "c2s_leads_stage"
+# Load modes: append every fetched lead, or upsert them by lead id
+LOAD_MODES = ("append", "merge")
+# Flattening: path always projected so merges can compare it, and the VARIANT
+# column that keeps every key not projected
+UPDATED_AT_PATH = "attributes.updated_at"
+RESIDUAL_COLUMN = "extra"
+
+
+def flatten_lead(lead, flatten_paths):
+    """
+    Projects the dotted flatten_paths of a lead (ex.: "attributes.status") to
+    top level columns named with underscores (ex.: "attributes_status"). The
+    top level scalars are kept as they are and everything else goes to the
+    RESIDUAL_COLUMN.
+    """
+    residual = copy.deepcopy(lead)
+    row = {}
+
+    for path in flatten_paths:
+        *parents, leaf = path.split(".")
+        node = residual
+        for key in parents:
+            node = node.get(key) if isinstance(node, dict) else None
+        row[path.replace(".", "_")] = node.pop(leaf, None) if isinstance(node, dict) else None
+
+    for key in list(residual):
+        if not isinstance(residual[key], (dict, list)):
+            row[key] = residual.pop(key)
+        elif not residual[key]:
+            residual.pop(key)
+
+    row[RESIDUAL_COLUMN] = residual or None
+    return row
+
+
+def updated_at_column(df):
+    """
+    Returns the lead updated_at as a timestamp column, for flattened and
+    nested tables alike.
+    """
+    flattened = UPDATED_AT_PATH.replace(".", "_").upper()
+    if flattened in df.columns:
+        return df[flattened]
+    return to_timestamp(df["ATTRIBUTES"]["updated_at"].cast("string"))
+
+
+def latest_leads(df):
+    """
+    Keeps a single version of each lead id of the staged leads, the most
+    recently updated one, so the batch can be merged deterministically.
+    """
+    window = Window.partition_by(df["ID"]).order_by(updated_at_column(df).desc_nulls_last())
+    return df.with_column("__ROW", row_number().over(window)).filter(col("__ROW") == 1).drop("__ROW")
+
+
+def table_exists(snowpark, table_identifier):
+    try:
+        snowpark.table(table_identifier).schema
+        return True
+    except Exception:
+        return False
 
 
 class C2SLead:
@@ -34,119 +120,68 @@ class C2SLead:
     - logger: logging.Logger
     - instance_url: str
     - token: str
+    - extractor: RestExtractor
+    - watermark: WatermarkStore
     """
 
     def __init__(
         self,
         logger: logging.Logger,
         instance_url: str,
-        token: str
+        token: str,
+        session: requests.Session = None,
+        rate_limiter: TokenBucket = None
     ):
         self.logger = logger
         self.instance_url = instance_url
         self.token = token
-
-    def get_last_update(self):
-        """
-        Reads the 'last_update' from a JSON file (LAST_UPDATE_PATH).
-        Returns None if it doesn't exist or if there's a failure.
-        Example: {"last_update": "2024-12-27T10:46:28Z"}
-        """
-        if not os.path.exists(LAST_UPDATE_PATH):
-            self.logger.info(f"[get_last_update] File {
-                             LAST_UPDATE_PATH} not found. Returning None.")
-            return None
-
-        try:
-            with open(LAST_UPDATE_PATH, "r") as f:
-                data = json.load(f)
-                last_update = data.get("last_update")
-                self.logger.info(
-                    f"[get_last_update] Loaded last_update {last_update}")
-                return last_update
-        except Exception as e:
-            self.logger.error(f"[get_last_update] Error loading file{
-                              LAST_UPDATE_PATH}: {e}")
-            return None
-
-    def save_last_update(self, timestamp_str):
-        """
-        Saves the 'last_update' to a JSON file (LAST_UPDATE_PATH).
-        """
-        try:
-            with open(LAST_UPDATE_PATH, "w") as f:
-                json.dump({"last_update": timestamp_str}, f)
-            self.logger.info(f"[save_last_update] Saved '{timestamp_str}' to {
-                             LAST_UPDATE_PATH} successfully.")
-        except Exception as e:
-            self.logger.error(f"[save_last_update] Error saving file {
-                              LAST_UPDATE_PATH}: {e}")
-            raise
-
-    def fetch_data(self, last_update=None):
+        self.extractor = RestExtractor(
+            session=session,
+            rate_limiter=rate_limiter or TokenBucket(
+                MAX_REQ_PER_MINUTE - BUCKET_CAPACITY,
+                capacity=BUCKET_CAPACITY,
+                min_rate_per_minute=MAX_REQ_PER_MINUTE * AIMD_MIN_RATE_FRACTION,
+                increase_fraction=AIMD_INCREASE_FRACTION
+            ),
+            logger=logger
+        )
+        self.watermark = WatermarkStore(LAST_UPDATE_PATH, logger=logger)
+
+    def get_checkpoint(self, last_update=None, per_page=PER_PAGE):
+        return PageCheckpoint(CHECKPOINT_PATH, f"{last_update or ''}|{per_page}")
+
+    def fetch_data(self, last_update=None, per_page=PER_PAGE, max_workers=1, on_page=None):
         """
         Fetches all leads from the C2S API.
         last_update: str - ISO 8601 format (ex.: "2024-12-27T10:46:28Z")
-        Returns a list of leads (dicts).
+        Returns a list of leads (dicts), in page order. When `on_page` is given,
+        each page is handed to it as soon as it arrives and nothing is kept in
+        memory.
+        Once a page reports 'meta.total', the remaining pages are fetched by up
+        to `max_workers` threads that share the same rate limiter.
+        Every completed page is saved to the checkpoint, so a failed run is
+        resumed from the next page instead of downloading everything again.
         """
+        per_page = min(max(1, per_page), MAX_PER_PAGE)
         headers = {
             'Authorization': f'Bearer {self.token}',
             'Content-Type': 'application/json'
-
         }
-        all_results = []
-        page = 1
-        count = 0
-
-        while True:
-            params = {
-                "page": page,
-                "perpage": PER_PAGE
-            }
-
-            if last_update:
-                params["updated_gte"] = last_update
-
-            self.logger.info(f"[fetch_data] Requesting page {
-                             page}, updated_gte={last_update}")
-            try:
-                response = requests.get(
-                    self.instance_url, headers=headers, params=params)
-                response.raise_for_status()
-                data = response.json()
-
-                leads = data.get("data", [])
-                if leads:
-                    all_results.extend(leads)
-                total = data.get("meta", {}).get("total", 0)
-
-                self.logger.info(f"[fetch_data] Page {page} returned {
-                                 len(leads)} leads. Total={total}")
-
-                if (PER_PAGE * page) >= total:
-                    self.logger.info(
-                        "[fetch_data] Completed fetching all pages.")
-                    break
-
-                page += 1
-                count += 1
-
-                # api wait 10 req per minute
-                if count == MAX_REQ_PER_MINUTE:
-                    self.logger.info(
-                        "[fetch_data] Rate limit reached: waiting 60 seconds...")
-                    time.sleep(60)
-                    count = 0
-
-            except requests.exceptions.HTTPError as e:
-                self.logger.error(
-                    f"[fetch_data] Request failed on page {page}: {e}")
-                raise e
-            except Exception as e:
-                logger.error(
-                    f"[fetch_data] Unexpected error on page {page}: {e}")
-                raise e
-
+        params = {"updated_gte": last_update} if last_update else {}
+
+        all_results = self.extractor.extract(
+            self.instance_url,
+            TotalCountPagination(page_param="page", size_param="perpage", per_page=per_page,
+                                 total_key="meta.total", items_key="data"),
+            params=params,
+            headers=headers,
+            checkpoint=self.get_checkpoint(last_update, per_page),
+            on_page=on_page,
+            max_workers=max(1, max_workers),
+            label=f"updated_gte={last_update}"
+        )
+
+        self.logger.info("[fetch_data] Completed fetching all pages.")
         return all_results
 
     def find_max_updated_at(self, leads):
@@ -174,19 +209,60 @@ class C2SLead:
 
         return max_dt.strftime("%Y-%m-%dT%H:%M:%SZ") if max_dt else None
 
-    def save_to_snowflake(self, snowpark, all_results, table_identifier):
+    def stage_writer(self, snowpark, table_identifier):
         """
-        Receives a list of leads and saves them to Snowflake by Snowpark.
+        Returns the writer that stages the leads, page by page, as compressed
+        Parquet files of up to LOAD_CHUNK_SIZE rows.
         """
-        if not table_identifier:
-            self.logger.info(
-                "[save_to_snowflake] No table identifier provided. Skipping save operation.")
-            return
+        transformed_tbl_identifier = table_identifier.replace('"', "").replace(".", "_")
+        return SnowflakeStageWriter(snowpark, SNOWFLAKE_STAGE, transformed_tbl_identifier,
+                                    chunk_size=LOAD_CHUNK_SIZE, logger=self.logger)
 
+    def merge_leads(self, snowpark, df_leads, table_identifier):
+        """
+        MERGEs the staged leads into the target table on the lead id. Matched
+        rows are only updated when the staged lead has a newer updated_at.
+        """
+        target = snowpark.table(table_identifier)
+        target_updated_at = updated_at_column(target)
+        source_updated_at = updated_at_column(df_leads)
+
+        columns = [name for name in df_leads.columns if name in target.columns]
+        set_clause = {name: df_leads[name] for name in columns}
+
+        result = target.merge(
+            source=df_leads,
+            join_expr=target["ID"] == df_leads["ID"],
+            clauses=[
+                when_matched(
+                    target_updated_at.is_null() | (source_updated_at > target_updated_at)
+                ).update(set_clause),
+                when_not_matched().insert(set_clause)
+            ]
+        )
+        self.logger.info(
+            f"[merge_leads] {result.rows_inserted} leads inserted and {result.rows_updated} updated in {table_identifier}")
+
+    def save_to_snowflake(self, snowpark, writer, table_identifier, load_mode="append"):
+        """
+        Bulk loads the leads staged by `writer` (see stage_writer) to Snowflake:
+        they are appended with a single server-side load, or upserted by lead
+        id when load_mode is "merge".
+        """
         try:
             logger.info(
-                "[save_to_snowflake] Converting list to Snowpark DataFrame...")
-            df_leads = snowpark.createDataFrame(all_results)
+                "[save_to_snowflake] Putting the staged Parquet files...")
+            df_leads = writer.close()
+            if df_leads is None:
+                return
+
+            if load_mode == "merge":
+                df_leads = latest_leads(df_leads)
+
+            if load_mode == "merge" and table_exists(snowpark, table_identifier):
+                logger.info(f"[save_to_snowflake] Merging leads into {table_identifier} on id...")
+                self.merge_leads(snowpark, df_leads, table_identifier)
+                return
 
             logger.info(f"[save_to_snowflake] Saving DataFrame to table {
                         table_identifier} (append mode)...")
@@ -198,31 +274,57 @@ class C2SLead:
                 f"[save_to_snowflake] Error saving data to Snowflake: {e}")
             raise e
 
-    def run(self, snowpark, table_identifier=None):
+    def run(self, snowpark, table_identifier=None, per_page=PER_PAGE, max_workers=1, load_mode="append",
+            flatten_paths=None):
         """
         Main method to orchestrate the process.
         """
 
+        if load_mode not in LOAD_MODES:
+            raise ValueError(f"load_mode must be one of {LOAD_MODES}, got {load_mode!r}")
+
         try:
-            last_update = self.get_last_update()
+            last_update = self.watermark.get()
             if last_update:
                 self.logger.info(
                     f"[run] Incremental load from updated_at={last_update}")
             else:
                 self.logger.info("[run] Full load - No 'last_update' found.")
 
-            leads = self.fetch_data(last_update)
-            logger.info(f"[main] Total leads fetched: {len(leads)}")
-
-            if leads:
-                new_last_update = self.find_max_updated_at(leads)
+            if table_identifier:
+                writer = self.stage_writer(snowpark, table_identifier)
+            else:
+                writer = None
+                self.logger.info(
+                    "[run] No table identifier provided. Skipping save operation.")
+            paths = list(dict.fromkeys([UPDATED_AT_PATH, *flatten_paths])) if flatten_paths else None
+            state = {"last_update": None, "count": 0}
+
+            def on_page(leads):
+                # Pages are staged as they arrive, only the watermark and count are kept
+                page_last_update = self.find_max_updated_at(leads)
+                if page_last_update and (not state["last_update"] or page_last_update > state["last_update"]):
+                    state["last_update"] = page_last_update
+                state["count"] += len(leads)
+                if writer:
+                    writer.write([flatten_lead(lead, paths) for lead in leads] if paths else leads)
+
+            self.fetch_data(last_update, per_page=per_page, max_workers=max_workers, on_page=on_page)
+            logger.info(f"[main] Total leads fetched: {state['count']}")
+
+            if state["count"]:
+                if writer:
+                    self.save_to_snowflake(snowpark, writer, table_identifier, load_mode)
+
+                # The watermark only moves once the leads are safely loaded
+                new_last_update = state["last_update"]
                 if new_last_update:
-                    self.save_last_update(new_last_update)
+                    self.watermark.save(new_last_update)
                 else:
                     self.logger.info(
                         "[run] No valid 'updated_at' found to save.")
 
-                self.save_to_snowflake(snowpark, leads, table_identifier)
+            self.get_checkpoint(last_update, per_page).clear()
 
         except Exception as e:
             self.logger.error(f"Error occured: {e}")
@@ -233,6 +335,11 @@ def orchest_handler():
     base_url = orchest.get_step_param('url')
     token = os.getenv("C2S_AUTHENTICATOR_TOKEN")
     table_identifier = orchest.get_step_param('table_identifier')
+    per_page = orchest.get_step_param('per_page') or PER_PAGE
+    max_workers = orchest.get_step_param('max_workers') or 1
+    http_pool_size = orchest.get_step_param('http_pool_size') or max(HTTP_POOL_SIZE, max_workers)
+    load_mode = orchest.get_step_param('load_mode') or "append"
+    flatten_paths = orchest.get_step_param('flatten_paths') or []
 
     if not token:
         raise Exception("C2S_AUTHENTICATOR_TOKEN is required")
@@ -240,10 +347,12 @@ def orchest_handler():
     handler = C2SLead(
         logger=logger,
         instance_url=base_url,
-        token=token
+        token=token,
+        session=get_http_session(pool_size=http_pool_size)
     )
     snowpark = get_snowpark_session(os.getenv("SECRET_ID"))
-    handler.run(snowpark, table_identifier)
+    handler.run(snowpark, table_identifier, per_page=per_page, max_workers=max_workers, load_mode=load_mode,
+                flatten_paths=flatten_paths)
 
 
 def script_handler():
@@ -256,6 +365,11 @@ def script_handler():
     base_url = config.get("url")
     token = config.get("token")
     table_identifier = config.get("table_identifier")
+    per_page = config.get("per_page", PER_PAGE)
+    max_workers = config.get("max_workers", 1)
+    http_pool_size = config.get("http_pool_size") or max(HTTP_POOL_SIZE, max_workers)
+    load_mode = config.get("load_mode", "append")
+    flatten_paths = config.get("flatten_paths", [])
 
     if not base_url or not token:
         raise ValueError(
@@ -264,10 +378,12 @@ def script_handler():
     handler = C2SLead(
         logger=logger,
         instance_url=base_url,
-        token=token
+        token=token,
+        session=get_http_session(pool_size=http_pool_size)
     )
     snowpark = get_snowpark_session(os.getenv("SECRET_ID"))
-    handler.run(snowpark, table_identifier)
+    handler.run(snowpark, table_identifier, per_page=per_page, max_workers=max_workers, load_mode=load_mode,
+                flatten_paths=flatten_paths)
 
 
 if __name__ == "__main__":
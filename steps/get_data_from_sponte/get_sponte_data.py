@@ -3,16 +3,29 @@ import logging
 import os
 import requests
 import pandas as pd
-import time
-import re
+import numpy as np
 import json
 import sys
-import math
-from datetime import datetime, timezone
+import threading
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import boto3
 from io import BytesIO
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
+from rest_extraction import (
+    HTTP_POOL_SIZE,
+    HasNextPagination,
+    PageCheckpoint,
+    ParquetPartitionWriter,
+    RestExtractor,
+    TokenBucket,
+    WatermarkStore,
+    get_http_session,
+)
 
 ORCHEST_STEP_UUID = os.environ.get('ORCHEST_STEP_UUID')
 
@@ -28,241 +41,426 @@ LAST_UPDATE_PATH = f"state/last_update_{endpoint}.json"
 # Set URL
 url = f"https://sponte-bi.sponteweb.com.br/api/v1/extracoes/{endpoint}"
 
-# Cálculo da quantidade máxima de requisições por step
-with open("main.orchest", "r", encoding="utf-8") as file:
-    json_data = json.load(file)
-    
-# Count occurrences of "get_sponte_data.py"
-count_of_steps = sum(1 for step in json_data["steps"].values() if step.get("file_path") == "get_sponte_data.py")
+# Compressão dos arquivos Parquet enviados ao S3
+PARQUET_COMPRESSION = "zstd"
+# Quantidade padrão de partições (dias) enviadas ao S3 em paralelo
+UPLOAD_WORKERS = 4
+
+# Tipos aceitos em schemas/schemas.json
+SCHEMA_TYPE_MAPPING = {
+    "int64": pa.int64(),
+    "int8": pa.int8(),
+    "float64": pa.float64(),
+    "string": pa.string(),
+    "timestamp[ns]": pa.timestamp("ns", tz=None)
+}
+
+# Caracteres removidos das colunas de texto
+ILLEGAL_CHARS_PATTERN = r'[<>:"/\\|?*\x00-\x1F\x7F]'
+
+# Formatos de data tentados, em ordem. Para 'DataExtracao' são os únicos aceitos;
+# as demais colunas de timestamp ainda tentam ISO e, sem sucesso, ficam nulas
+DATA_EXTRACAO_FORMATS = [
+    "%Y-%m-%dT%H%M%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%d/%m/%Y %H:%M",
+    "%Y-%m-%d",
+    "%Y-%m-%dT%H%M%S"
+]
+
+# Limite de requisições por minuto da API Sponte, compartilhado por todos os steps do nó
+MAX_REQ_PER_MINUTE = 1000
+# Rajada máxima do token bucket. É descontada da taxa de reposição para que nenhuma
+# janela de 60 segundos ultrapasse MAX_REQ_PER_MINUTE
+BUCKET_CAPACITY = 10
+
+# Checkpoints da paginação, um por endpoint e CodCliSponte
+CHECKPOINT_DIR = "state/checkpoints"
+# Estado do token bucket compartilhado entre os processos (steps) Sponte
+QUOTA_STATE_PATH = os.environ.get("SPONTE_QUOTA_PATH", "state/sponte_quota.json")
+
+
+def merge_partition(existing, new, merge_keys):
+    """
+    Junta uma partição existente com os dados novos, mantendo uma linha por
+    chave primária (`merge_keys`). Em caso de conflito, a linha nova vence.
+    Colunas adicionadas ao schema depois que a partição foi gravada entram
+    como nulas nas linhas existentes.
+    """
+    for field in new.schema:
+        if field.name not in existing.schema.names:
+            existing = existing.append_column(field, pa.nulls(existing.num_rows, type=field.type))
+
+    combined = pa.concat_tables([existing.select(new.schema.names).cast(new.schema), new])
+    combined = combined.append_column("__row", pa.array(np.arange(combined.num_rows)))
+
+    rows = combined.group_by(merge_keys).aggregate([("__row", "max")])["__row_max"]
+    return combined.take(rows.take(pc.sort_indices(rows))).select(new.schema.names)
+
+
+def parse_iso_datetime(value):
+    """
+    Lê uma data como o pd.to_datetime(errors='coerce') da versão anterior, já
+    sem fuso horário. Valores não reconhecidos viram NaT.
+    """
+    parsed = pd.to_datetime(value, errors='coerce')
+    if pd.notna(parsed) and parsed.tzinfo is not None:
+        parsed = parsed.tz_convert(None)
+    return parsed
+
+
+def parse_datetimes(values, strict=True):
+    """
+    Converte uma série de textos de data com os formatos de DATA_EXTRACAO_FORMATS.
+    Cada formato é aplicado de uma vez à série inteira, somente sobre os valores
+    que ainda não foram reconhecidos. Nulos e textos vazios continuam nulos.
+    Com `strict`, um valor que não corresponde a nenhum formato gera ValueError;
+    sem ele, o valor ainda é lido como ISO (ver `parse_iso_datetime`) ou fica nulo.
+    """
+    values = pd.Series(values, dtype="object")
+    present = values.notna() & (values.astype(str).str.strip() != "")
+    parsed = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+
+    for fmt in DATA_EXTRACAO_FORMATS:
+        pending = present & parsed.isna()
+        if not pending.any():
+            break
+        parsed[pending] = pd.to_datetime(values[pending].astype(str), format=fmt, errors='coerce')
+
+    unparsed = values[present & parsed.isna()]
+    if unparsed.empty:
+        return parsed
+    if strict:
+        raise ValueError(f"Date format not recognized: {unparsed.iloc[0]}")
+
+    fallback = {value: parse_iso_datetime(value) for value in unparsed.astype(str).unique()}
+    parsed[unparsed.index] = unparsed.astype(str).map(fallback).astype("datetime64[ns]")
+    return parsed
+
+
+def parse_timestamps(column, strict=True):
+    """
+    Converte uma coluna de texto do Arrow para timestamp[ns] com `parse_datetimes`.
+    """
+    parsed = parse_datetimes(column.to_pandas(), strict=strict)
+    return pa.array(parsed, type=pa.timestamp("ns"), from_pandas=True)
+
+
+def coerce_column(values, arrow_type):
+    """
+    Converte os valores de uma coluna para `arrow_type`. Valores que não
+    puderem ser convertidos viram nulos.
+    """
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+
+    if pa.types.is_string(arrow_type):
+        return pa.array([None if v is None else str(v) for v in values], type=arrow_type)
+
+    numbers = pd.to_numeric(pd.Series(values, dtype="object"), errors='coerce')
+    return pc.cast(pa.array(numbers, from_pandas=True), arrow_type, safe=False)
+
+
+class EndpointSchema:
+    """
+    Schema Arrow de um endpoint e o plano de conversão das suas colunas,
+    compilados uma única vez a partir de schemas/schemas.json.
+    """
+
+    def __init__(self, entity_name, columns):
+        fields = []
+        for column, dtype in columns.items():
+            if dtype not in SCHEMA_TYPE_MAPPING:
+                raise ValueError(f"Unsupported type '{dtype}' in schema for '{column}'.")
+            fields.append((column, SCHEMA_TYPE_MAPPING[dtype]))
+
+        self.entity_name = entity_name
+        self.schema = pa.schema(fields)
+        # Timestamps chegam da API como texto: são lidos como string e convertidos depois
+        self.input_schema = pa.schema([
+            (field.name, pa.string() if pa.types.is_timestamp(field.type) else field.type)
+            for field in self.schema
+        ])
+        self.timestamp_columns = [field.name for field in self.schema if pa.types.is_timestamp(field.type)]
+
+    def to_table(self, data):
+        """
+        Monta a tabela Arrow direto da lista de registros. Se algum valor não for
+        compatível com o tipo da sua coluna, as colunas são convertidas uma a uma
+        com coerção, como no pd.to_numeric(errors='coerce').
+        """
+        try:
+            table = pa.Table.from_pylist(data, schema=self.input_schema)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            table = pa.Table.from_arrays(
+                [coerce_column([row.get(field.name) for row in data], field.type) for field in self.input_schema],
+                schema=self.input_schema
+            )
+
+        # Somente 'DataExtracao' (a marca d'água) exige um formato conhecido
+        for name in self.timestamp_columns:
+            index = table.schema.get_field_index(name)
+            parsed = parse_timestamps(table.column(index), strict=name == 'DataExtracao')
+            table = table.set_column(index, self.schema.field(name), parsed)
+        return table
+
+
+@functools.lru_cache(maxsize=None)
+def read_schemas_file(schema_file):
+    with open(schema_file, "r") as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=None)
+def get_endpoint_schema(entity_name, schema_file="schemas/schemas.json"):
+    """
+    Registro dos schemas: o arquivo é lido e cada endpoint é compilado
+    somente na primeira chamada.
+    """
+    schemas = read_schemas_file(schema_file)
+
+    if entity_name not in schemas:
+        raise ValueError(f"Schema for entity '{entity_name}' not found in file.")
+
+    return EndpointSchema(entity_name, schemas[entity_name])
 
-# Cálculo para o Máximo de requesições da API
-MAX_REQ_PER_MINUTE = 1000/count_of_steps
-MAX_REQ_PER_MINUTE = math.floor(MAX_REQ_PER_MINUTE)
 
 class SponteAPI:
     def __init__(
         self,
         logger: logging.Logger,
-        api_key: str
+        api_key: str,
+        rate_limiter: TokenBucket = None,
+        session: requests.Session = None
     ):
         self.logger = logger
         self.api_key = api_key
+        self.extractor = RestExtractor(
+            session=session,
+            rate_limiter=rate_limiter or TokenBucket(
+                MAX_REQ_PER_MINUTE - BUCKET_CAPACITY,
+                capacity=BUCKET_CAPACITY,
+                state_path=QUOTA_STATE_PATH
+            ),
+            logger=logger
+        )
+        self.watermark = WatermarkStore(LAST_UPDATE_PATH, logger=logger)
 
 
-    # Load schema from JSON file
     def load_schema_from_file(self, entity_name, schema_file="schemas/schemas.json"):
-        with open(schema_file, "r") as f:
-            schemas = json.load(f)
+        """
+        Retorna o schema Arrow do endpoint, compilado uma única vez por execução.
+        """
+        return get_endpoint_schema(entity_name, schema_file).schema
 
-        if entity_name not in schemas:
-            raise ValueError(f"Schema for entity '{entity_name}' not found in file.")
+    def find_max_updated_at(self, data):
+        """
+        Identifica o maior valor de 'DataExtracao' nos dados (lista de registros
+        ou tabela Arrow já tipada pelo schema do endpoint).
+        Nos dois casos as datas são lidas com os formatos de DATA_EXTRACAO_FORMATS
+        (ver `parse_datetimes`).
+        Retorna o timestamp no formato 'YYYY-MM-DDT00:00:00Z'.
+        """
+        if isinstance(data, pa.Table):
+            max_dt = pc.max(data['DataExtracao']).as_py()
+        else:
+            max_dt = parse_datetimes([d.get("DataExtracao") for d in data]).max()
+            max_dt = None if pd.isna(max_dt) else max_dt
+        return max_dt.strftime("%Y-%m-%dT00:00:00Z") if max_dt else None
+
+    def get_checkpoint(self, cod_cli_sponte, data_extracao):
+        return PageCheckpoint(os.path.join(CHECKPOINT_DIR, f"{endpoint}_{cod_cli_sponte}"), data_extracao)
+
+    def clear_checkpoints(self, sponte_code_list, data_extracao):
+        for cod_cli in sponte_code_list:
+            self.get_checkpoint(cod_cli, data_extracao).clear()
+        self.logger.info("[clear_checkpoints] Checkpoints removidos.")
+
+    def fetch_data(self, cod_cli_sponte, data_extracao, api_key, on_page=None):
+        """
+        Faz a chamada à API, paginando até o fim para um CodCliSponte.
+        Cada requisição consome um token do rate limiter compartilhado.
+        Se `on_page` for informado, cada página é entregue a ele assim que chega
+        e nada é acumulado em memória.
+        Cada página concluída é gravada no checkpoint do cliente: se a execução
+        anterior falhou, as páginas já baixadas são reaproveitadas e a paginação
+        continua da página seguinte.
+        """
 
-        # Convert JSON structure to PyArrow schema
-        fields = []
-        type_mapping = {
-            "int64": pa.int64(),
-            "int8": pa.int8(),
-            "float64": pa.float64(),
-            "string": pa.string(),
-            "timestamp[ns]": pa.timestamp("ns", tz=None)
+        params = {
+            'CodCliSponte': cod_cli_sponte,
+            'DataExtracao': data_extracao
         }
-
-        for column, dtype in schemas[entity_name].items():
-            if dtype not in type_mapping:
-                raise ValueError(f"Unsupported type '{dtype}' in schema for '{column}'.")
-            fields.append((column, type_mapping[dtype]))
-
-        return pa.schema(fields)
-        
-    def get_last_update(self):
+        return self.extractor.extract(
+            url,
+            HasNextPagination(page_param='PageNumber', has_next_key='hasNext', items_key='items'),
+            params=params,
+            headers={'x-api-key': api_key},
+            checkpoint=self.get_checkpoint(cod_cli_sponte, data_extracao),
+            on_page=on_page,
+            label=f"CodCliSponte {cod_cli_sponte}"
+        )
+
+    def fetch_all(self, sponte_code_list, data_extracao, api_key, max_workers=1, on_page=None):
         """
-        Lê o 'last_update' de um arquivo JSON (LAST_UPDATE_PATH).
-        Retorna None se não existir ou se houver falha.
-        Exemplo: {"last_update": "2024-12-27T10:46:28Z"}
+        Busca os dados de todos os CodCliSponte, com até `max_workers` clientes
+        paginando em paralelo. Todas as threads consomem do mesmo rate limiter.
+        Os dados são retornados na ordem de `sponte_code_list`, exceto quando
+        `on_page` é informado (ver `fetch_data`).
         """
-        if not os.path.exists(LAST_UPDATE_PATH):
-            self.logger.info(f"[get_last_update] Arquivo {LAST_UPDATE_PATH} não encontrado. Retornando None.")     
-            return None
+        def fetch_client(cod_cli):
+            self.logger.info(f'[fetch_all] Fetching data for CodCliSponte: {cod_cli}')
+            return self.fetch_data(cod_cli, data_extracao, api_key, on_page=on_page)
 
-        try:
-            with open(LAST_UPDATE_PATH, "r") as f:
-                data = json.load(f)
-                last_update = data.get("last_update")
-                self.logger.info(f"[get_last_update] last_update carregado: {last_update}")
-                return last_update
-        except Exception as e:
-            self.logger.error(f"[get_last_update] Erro ao carregar o arquivo {LAST_UPDATE_PATH}: {e}")
-            return None
+        all_data = []
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for data in executor.map(fetch_client, sponte_code_list):
+                all_data.extend(data)
+        return all_data
 
-    def save_last_update(self, timestamp_str):
+    def clean_data(self, table):
         """
-        Salva o timestamp (ex.: '2024-01-01T00:00:00Z') em arquivo JSON.
+        Remove caracteres ilegais das colunas do tipo string da tabela Arrow,
+        uma coluna inteira por vez. Colunas de outros tipos não são alteradas.
         """
-        try:
-            with open(LAST_UPDATE_PATH, "w") as f:
-                json.dump({"last_update": timestamp_str}, f)
-            self.logger.info(f"[save_last_update] Valor '{timestamp_str}' salvo com sucesso em {LAST_UPDATE_PATH}.")
-        except Exception as e:
-            self.logger.error(f"[save_last_update] Erro ao salvar no arquivo {LAST_UPDATE_PATH}: {e}")
-            raise
+        for index, field in enumerate(table.schema):
+            if pa.types.is_string(field.type):
+                cleaned = pc.replace_substring_regex(table.column(index), pattern=ILLEGAL_CHARS_PATTERN, replacement='')
+                table = table.set_column(index, field, cleaned)
+        return table
 
-    def find_max_updated_at(self, data):
-        """
-        Percorre a lista dos dados e identifica o maior valor de 'DataExtracao'.
-        Retorna o timestamp no formato 'YYYY-MM-DDTHH:MM:SSZ'.
+    def clean_dataframe(self, data):
         """
-        max_dt = None
-
-        formats = [
-            "%Y-%m-%dT%H%M%S.%f",  
-            "%Y-%m-%d %H:%M:%S",    
-            "%d/%m/%Y %H:%M",       
-            "%Y-%m-%d",
-            "%Y-%m-%dT%H%M%S"
-        ]
-        
-        for d in data:
-            attributes = d.get("DataExtracao")
-            def parse_datetime(attributes):
-                for fmt in formats:
-                    try:
-                        return datetime.strptime(attributes, fmt)
-                    except ValueError:
-                        continue  # Try the next format
-
-                raise ValueError(f"Date format not recognized: {attributes}")
-
-            dt = parse_datetime(attributes)
-            # Format to the desired format
-            formatted_date = dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-            if formatted_date:
-                try:
-                    dt = datetime.fromisoformat(formatted_date.replace("Z", "+00:00"))
-                    dt_utc = dt.astimezone(timezone.utc)
-                    if not max_dt or dt > max_dt:
-                        max_dt = dt_utc
-                except ValueError:
-                    # Caso o formato não seja compatível, ignora e segue
-                    self.logger.info(f"[find_max_updated_at] Formato inválido: {formatted_date}")
-                    pass
-        if max_dt:
-            formatted = max_dt.strftime("%Y-%m-%dT00:00:00Z")
-            return formatted
-        return None
-
-    def fetch_data(self, cod_cli_sponte, data_extracao, api_key, count):
-        """
-        Faz a chamada à API.
+        Monta o DataFrame com todos os campos retornados pela API, como antes da
+        conversão para o schema do endpoint, e remove os caracteres ilegais das
+        células de texto, uma coluna inteira por vez.
         """
-
-        headers = {'x-api-key': api_key}
-        page_number = 1
-        all_items = []
-
-        while True:
-            params = {
-                'CodCliSponte': cod_cli_sponte,
-                'DataExtracao': data_extracao,
-                'PageNumber': page_number
-            }
+        df = pd.DataFrame(data)
+        for name in df.columns:
+            if not (pd.api.types.is_object_dtype(df[name]) or pd.api.types.is_string_dtype(df[name])):
+                continue
             try:
-                response = requests.get(url, headers=headers, params=params)
-                response.raise_for_status()  # Verifica se houve erro HTTP
-                data = response.json()
-                status_code = response.status_code
-
-                # Log da resposta do servidor
-                self.logger.info(f"Response for CodCliSponte {cod_cli_sponte}: CurrentPage({data['currentPage']}), TotalPages({data['totalPages']}), StatusCode:{status_code})")
-                all_items.extend(data['items'])
-
-                count += 1
-
-                # api wait MAX_REQ_PER_MINUTE
-                if count == MAX_REQ_PER_MINUTE:
-                    logger.info("[fetch_data] Limite de req/min atingido: aguardando 60 segundos...")
-                    time.sleep(60)
-                    count=0
-
-                # Verifica se há mais páginas
-                if not data.get('hasNext'):
-                    break
-                page_number += 1
-
-            except requests.exceptions.HTTPError as err:
-                self.logger.info(f'HTTP error occurred for CodCliSponte {cod_cli_sponte}: {err}')
-                self.logger.info(f'Server response: {response.text}')
-                break
-            except Exception as e:
-                self.logger.info(f'An error occurred for CodCliSponte {cod_cli_sponte}: {e}')
-                break
-
-        return all_items, count
-
-    def clean_data(self, data):
-        # Função para remover caracteres ilegais de strings
-        illegal_chars = re.compile(r'[<>:"/\\|?*\x00-\x1F\x7F]')
-        for item in data:
-            for key in item.keys():
-                if isinstance(item[key], str):
-                    item[key] = illegal_chars.sub('', item[key])
-        return data
-    
-    def process_and_send_df_to_next_step(self, data):
+                cleaned = df[name].str.replace(ILLEGAL_CHARS_PATTERN, '', regex=True)
+            except AttributeError:
+                # Coluna sem nenhum texto (ex.: somente nulos ou objetos)
+                continue
+            # Células que não são texto voltam como nulo no `.str` e mantêm o valor original
+            df[name] = cleaned.where(cleaned.notna(), df[name])
+        return df
+
+    def process_and_send_df_to_next_step(self, df_sponte):
         outgoing_variable_name = orchest.get_step_param('outgoing_variable_name')
         
-        df_sponte = pd.DataFrame(data)
         if df_sponte.empty:
             self.logger.info("Nenhum dado para processar.")
             return
         orchest.output(df_sponte, name=outgoing_variable_name)
         self.logger.info(f"[process_and_send_to_next_step] Dataframe exportado para variável '{outgoing_variable_name}' com sucesso.")
         
-    def process_and_upload_to_s3(self, data, bucket_name, prefix):
-        """Converts data to a DataFrame, splits by 'DataExtracao', and uploads each split file to S3."""
-        client = boto3.client('s3', region_name='us-east-1')
-        df = pd.DataFrame(data)
-        schema = self.load_schema_from_file(entity_name=endpoint)
+    def to_arrow_table(self, data):
+        """Converts a list of records to an Arrow table using the compiled endpoint schema."""
+        return get_endpoint_schema(endpoint).to_table(data)
+
+    def partition_path(self, prefix, date, hive_partitioning=False):
+        file_name = f"{endpoint}_{date}.parquet"
+        if hive_partitioning:
+            return f"{prefix}/dt={date}/{file_name}"
+        return f"{prefix}/{file_name}"
+
+    def read_partition(self, client, bucket_name, s3_path):
+        """Reads a partition already in S3. Returns None if it does not exist."""
+        try:
+            response = client.get_object(Bucket=bucket_name, Key=s3_path)
+        except client.exceptions.NoSuchKey:
+            return None
+        return pq.read_table(BytesIO(response['Body'].read()))
 
-        for field in schema:
-            col_name = field.name
-            col_type = field.type
-
-            if col_name in df.columns:
-                if pa.types.is_integer(col_type):
-                    df[col_name] = pd.to_numeric(df[col_name], errors='coerce').astype('Int64')
-                elif pa.types.is_floating(col_type):
-                    df[col_name] = pd.to_numeric(df[col_name], errors='coerce').astype(float)
-                elif pa.types.is_boolean(col_type):
-                    df[col_name] = df[col_name].astype(bool)
-                elif pa.types.is_timestamp(col_type):
-                    df[col_name] = pd.to_datetime(df[col_name], errors='coerce').astype('datetime64[ns]')
-                else:
-                    df[col_name] = df[col_name].astype('string')  
+    def upload_partition(self, client, date, source, bucket_name, prefix,
+                         hive_partitioning=False, row_group_size=None, merge_keys=None):
+        """
+        Uploads one 'DataExtracao' day to S3. `source` is an Arrow table or the path of a
+        local Parquet file. With `merge_keys`, the partition already in S3 is read and
+        deduplicated by those columns, keeping the new rows, before being rewritten.
+        """
+        s3_output_path = self.partition_path(prefix, date, hive_partitioning)
+
+        if merge_keys:
+            table = pq.read_table(source) if isinstance(source, str) else source
+            existing = self.read_partition(client, bucket_name, s3_output_path)
+            if existing is not None:
+                table = merge_partition(existing, table, merge_keys)
+                self.logger.info(f"Merged {date} with the existing partition in s3://{bucket_name}/{s3_output_path}")
+            source = table
+
+        if isinstance(source, str):
+            client.upload_file(source, bucket_name, s3_output_path)
+        else:
+            buffer = BytesIO()
+            pq.write_table(source, buffer, compression=PARQUET_COMPRESSION, row_group_size=row_group_size)
+            buffer.seek(0)
+            client.upload_fileobj(buffer, bucket_name, s3_output_path)
 
-                
+        self.logger.info(f"Uploaded split file to s3://{bucket_name}/{s3_output_path}")
 
-        df['DataExtracao'] = pd.to_datetime(df['DataExtracao'], errors='coerce').astype('datetime64[ns]')
+    def process_and_upload_to_s3(self, table, bucket_name, prefix, upload_workers=UPLOAD_WORKERS, **upload_options):
+        """Splits the Arrow table by 'DataExtracao' and uploads the split files to S3 in parallel."""
+        client = boto3.client('s3', region_name='us-east-1')
+        dates = pc.cast(table['DataExtracao'], pa.date32())
 
-        for date, group in df.groupby(df['DataExtracao'].dt.date):
-            file_name = f"{endpoint}_{date}.parquet"
-            s3_output_path = f"{prefix}/{file_name}"
+        def upload(date):
+            group = table.filter(pc.equal(dates, pa.scalar(date, pa.date32())))
+            self.upload_partition(client, date, group, bucket_name, prefix, **upload_options)
 
-            buffer = BytesIO()
-            
-            schema = self.load_schema_from_file(entity_name=endpoint)
-            
-            table = pa.Table.from_pandas(group, schema=schema, preserve_index=False)
+        with ThreadPoolExecutor(max_workers=max(1, upload_workers)) as executor:
+            list(executor.map(upload, sorted(d for d in pc.unique(dates).to_pylist() if d is not None)))
 
-            pq.write_table(table, buffer)
+    def stream_and_upload_to_s3(self, sponte_code_list, data_extracao, api_key, bucket_name, prefix, max_workers=1,
+                                upload_workers=UPLOAD_WORKERS, **upload_options):
+        """
+        Modo streaming: cada página é limpa, convertida para Arrow com o schema
+        do endpoint e gravada como row group no arquivo Parquet local do seu dia.
+        Ao final, os arquivos são enviados ao S3.
+        Retorna o maior 'DataExtracao' encontrado e a quantidade de registros.
+        """
+        client = boto3.client('s3', region_name='us-east-1')
+        schema = self.load_schema_from_file(entity_name=endpoint)
+        state = {"last_update": None, "count": 0}
+        lock = threading.Lock()
+
+        with tempfile.TemporaryDirectory() as directory:
+            writer = ParquetPartitionWriter(
+                schema, directory, partition_column='DataExtracao', file_prefix=endpoint,
+                row_group_size=upload_options.get('row_group_size'), compression=PARQUET_COMPRESSION
+            )
+
+            def on_page(items):
+                if not items:
+                    return
+                table = self.clean_data(self.to_arrow_table(items))
+                page_last_update = self.find_max_updated_at(table)
+                writer.write(table)
+
+                with lock:
+                    state["count"] += table.num_rows
+                    if page_last_update and (not state["last_update"] or page_last_update > state["last_update"]):
+                        state["last_update"] = page_last_update
 
-            buffer.seek(0)
-            
-            client.upload_fileobj(buffer, bucket_name, s3_output_path)
+            try:
+                self.fetch_all(sponte_code_list, data_extracao, api_key, max_workers=max_workers, on_page=on_page)
+            finally:
+                paths = writer.close()
 
+            with ThreadPoolExecutor(max_workers=max(1, upload_workers)) as executor:
+                list(executor.map(
+                    lambda date: self.upload_partition(client, date, paths[date], bucket_name, prefix, **upload_options),
+                    sorted(paths)
+                ))
 
-            self.logger.info(f"Uploaded split file to s3://{bucket_name}/{s3_output_path}")
-            
-    def run(self, sponte_code_list, data_extracao, api_key, is_historical:bool=False):
+        return state["last_update"], state["count"]
+
+    def run(self, sponte_code_list, data_extracao, api_key, is_historical:bool=False, max_workers:int=1):
         """
         Fluxo principal
         """
@@ -270,16 +468,21 @@ class SponteAPI:
         prefix = orchest.get_step_param('prefix')
         
         output_type = orchest.get_step_param('output_type')
+        streaming_upload = orchest.get_step_param('streaming_upload')
+        typed_dataframe = orchest.get_step_param('typed_dataframe')
+        upload_options = {
+            'upload_workers': orchest.get_step_param('upload_workers') or UPLOAD_WORKERS,
+            'hive_partitioning': bool(orchest.get_step_param('hive_partitioning')),
+            'row_group_size': orchest.get_step_param('row_group_size'),
+            'merge_keys': orchest.get_step_param('merge_keys')
+        }
         
         if prefix is None:
                 prefix = ''
         
-        all_data = []
-        count = 0
-
         try:
             # Get last param date
-            last_update = self.get_last_update()
+            last_update = self.watermark.get()
             
             if last_update and not is_historical:
                 dt = datetime.strptime(last_update, "%Y-%m-%dT%H:%M:%SZ")
@@ -290,43 +493,66 @@ class SponteAPI:
                 
             else:
                 self.logger.info(f"[run] FULL LOAD - Buscando dados a partir do dia {data_extracao}")
+
+            if output_type == "upload_to_s3" and streaming_upload:
+                new_last_update, count = self.stream_and_upload_to_s3(
+                    sponte_code_list, data_extracao, api_key, bucket_name, prefix, max_workers=max_workers, **upload_options
+                )
+                self.logger.info(f'[run] Total de registros coletados: {count}')
+                self.logger.info(f"[run] Valor encontrado: {new_last_update}")
+
+                if new_last_update:
+                    self.watermark.save(new_last_update)
+                    self.logger.info(f"[run] Arquivo '{LAST_UPDATE_PATH}' atualizado.")
+                else:
+                    self.logger.info("[run] Nenhum dado retornado. Finalizando o Step")
+                self.clear_checkpoints(sponte_code_list, data_extracao)
+                return
+
             # Chamada da API de todas as filiais
-            for cod_cli in sponte_code_list:
-                self.logger.info(f'[run] Fetching data for CodCliSponte: {cod_cli}')
-                data, count = self.fetch_data(cod_cli, data_extracao, api_key, count)
-                all_data.extend(data)
+            all_data = self.fetch_all(sponte_code_list, data_extracao, api_key, max_workers=max_workers)
             self.logger.info(f'[run] Total de registros coletados: {len(all_data)}')
 
-            # Limpa os dados
+            # Converte para o schema do endpoint e limpa os dados. O DataFrame de saída só
+            # usa o schema com `typed_dataframe`; sem ele, mantém todos os campos da API
             if all_data:
-                cleaned_data = self.clean_data(all_data)
+                if output_type == "send_dataframe_to_next_step" and not typed_dataframe:
+                    new_last_update = self.find_max_updated_at(all_data)
+                    cleaned_data = self.clean_dataframe(all_data)
+                else:
+                    cleaned_data = self.clean_data(self.to_arrow_table(all_data))
+                    new_last_update = self.find_max_updated_at(cleaned_data)
+                del all_data
                 self.logger.info(f"[run] Todos os dados limpos.")
             else:
-                cleaned_data = all_data
+                cleaned_data = None
                 self.logger.info(f"[run] Nenhum dado para limpeza.")
 
-            if cleaned_data:
+            if cleaned_data is not None:
                 
                 if output_type == "send_dataframe_to_next_step":
+                    if isinstance(cleaned_data, pa.Table):
+                        cleaned_data = cleaned_data.to_pandas()
                     self.process_and_send_df_to_next_step(cleaned_data)
                     self.logger.info("[run] Dataframe enviado para o próximo step")
                 elif output_type == "upload_to_s3":
-                    self.process_and_upload_to_s3(cleaned_data, bucket_name, prefix)
+                    self.process_and_upload_to_s3(cleaned_data, bucket_name, prefix, **upload_options)
                     self.logger.info("[run] Dados transformados em parquet e fazendo upload para o S3")
                 else:
                     self.logger.info("[run] Nenhum 'updated_at' válido encontrado; nada a salvar.")
                 
-                new_last_update = self.find_max_updated_at(cleaned_data)
                 self.logger.info(f"[run] Valor encontrado: {new_last_update}")
 
                 if new_last_update:
-                    self.save_last_update(new_last_update)
+                    self.watermark.save(new_last_update)
                     self.logger.info(f"[run] Arquivo '{LAST_UPDATE_PATH}' atualizado.")
                 else:
                     self.logger.info("[run] Nenhum 'DataExtracao' válido encontrado; nada a salvar.")
             else:
                 self.logger.info("[run] Nenhum dado retornado. Finalizando o Step")
 
+            self.clear_checkpoints(sponte_code_list, data_extracao)
+
         except Exception as e:
             self.logger.info(f"Ocorreu um erro: {e}")
             raise
@@ -334,6 +560,8 @@ class SponteAPI:
 def orchest_handler():
     api_key = os.getenv('x-api-key')
     input_type = orchest.get_step_param('input_type')
+    max_workers = orchest.get_step_param('max_workers') or 1
+    http_pool_size = orchest.get_step_param('http_pool_size') or max(HTTP_POOL_SIZE, max_workers)
 
     if input_type == "from_step_param":
         data_extracao = orchest.get_step_param('data_extracao')
@@ -352,9 +580,10 @@ def orchest_handler():
     
     handler = SponteAPI(
         logger=logger,
-        api_key=api_key
+        api_key=api_key,
+        session=get_http_session(pool_size=http_pool_size)
     )
-    handler.run(sponte_code_list, data_extracao, api_key, is_historical=is_historical)
+    handler.run(sponte_code_list, data_extracao, api_key, is_historical=is_historical, max_workers=max_workers)
 
 def script_handler():
     if len(sys.argv) != 2:
@@ -0,0 +1,806 @@
+"""
+Incremental REST extraction engine shared by the API steps.
+
+The same file is kept in every step directory that uses it (the steps are
+deployed independently), so changes must be copied to all of them
+(tests/test_rest_extraction.py checks that the copies are identical):
+- steps/get_data_from_c2s/rest_extraction.py
+- steps/get_data_from_sponte/rest_extraction.py
+
+It provides:
+- an HTTP session with keep-alive pooling, compression and default timeout
+- an adaptive (AIMD) token bucket rate limiter, optionally shared between
+  processes through a state file
+- pagination strategies (page number, hasNext, total count, cursor)
+- page checkpoints, so failed runs resume where they stopped
+- a watermark store for incremental loads
+- batched sinks: the pages are accumulated for DataFrame outputs, or streamed
+  to local Parquet partitions for S3 (`ParquetPartitionWriter`) or to a
+  Snowflake stage (`SnowflakeStageWriter`)
+"""
+import os
+import json
+import time
+import math
+import random
+import datetime
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+import fcntl
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+logger = logging.getLogger(__name__)
+
+# Connect and read timeouts (seconds) for the API requests
+REQUEST_TIMEOUT = (10, 120)
+# Keep-alive connections kept by the HTTP session
+HTTP_POOL_SIZE = 10
+
+# HTTP status codes meaning the server is throttling us: the page is retried with backoff
+THROTTLE_STATUS_CODES = {429, 503}
+MAX_RETRIES = 8
+MAX_BACKOFF_SECONDS = 60
+RETRY_JITTER = 0.25
+# Adaptive rate (AIMD): fraction of the maximum rate added on every success,
+# factor applied on every throttle and minimum rate, as a fraction of the maximum
+AIMD_INCREASE_FRACTION = 0.01
+AIMD_DECREASE_FACTOR = 0.5
+AIMD_MIN_RATE_FRACTION = 0.05
+
+PARQUET_COMPRESSION = "zstd"
+# Records per Parquet file staged in Snowflake
+STAGE_CHUNK_SIZE = 10000
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout when the request sets none."""
+
+    def __init__(self, *args, timeout=REQUEST_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def get_http_session(pool_size=HTTP_POOL_SIZE, timeout=REQUEST_TIMEOUT):
+    """
+    Creates an HTTP session with a keep-alive connection pool, a default
+    timeout and compression negotiation (gzip/deflate, plus br when brotli
+    is installed). The same session is shared by all the threads of a step.
+    """
+    session = requests.Session()
+    adapter = TimeoutHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, timeout=timeout)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+    return session
+
+
+def get_path(data, path):
+    """
+    Returns the value of a dotted path (ex.: "meta.total") in nested dicts,
+    or None when any key is missing.
+    """
+    for key in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def write_json_atomic(path, data):
+    """
+    Writes the JSON to a temporary file in the same directory and renames it
+    over the target, so the file is never left half-written.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f.name, path)
+
+
+def parse_retry_after(value):
+    """
+    Converts a Retry-After header (seconds or HTTP date) to seconds to wait.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return max(0.0, (parsedate_to_datetime(value) - now).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def rate_limit_reset_delay(response):
+    """
+    When the rate limit headers report an exhausted quota, returns how many
+    seconds are left until it resets. Otherwise returns None.
+    """
+    headers = response.headers
+    remaining = headers.get("RateLimit-Remaining", headers.get("X-RateLimit-Remaining"))
+    reset = headers.get("RateLimit-Reset", headers.get("X-RateLimit-Reset"))
+    try:
+        if remaining is None or reset is None or float(remaining) > 0:
+            return None
+        reset = float(reset)
+    except ValueError:
+        return None
+    # Some servers send the reset instant (epoch) instead of the seconds left
+    return max(0.0, reset - time.time()) if reset > 1e9 else reset
+
+
+def throttle_delay(response, attempt):
+    """
+    Time to wait before retrying a request throttled by the server: the
+    Retry-After, or an exponential backoff, always with jitter.
+    """
+    delay = parse_retry_after(response.headers.get("Retry-After"))
+    if delay is None:
+        delay = min(MAX_BACKOFF_SECONDS, 2 ** attempt)
+    return delay * random.uniform(1.0, 1.0 + RETRY_JITTER)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter with continuous refill. A single instance is
+    shared by the threads calling the API. With `state_path`, the bucket state
+    lives in a file guarded by `flock` and every process on the node draws
+    from the same quota.
+    The rate is adaptive (AIMD): it is halved when the server throttles us
+    (`on_throttle`) and grows back on every success (`on_success`), up to
+    `rate_per_minute`.
+
+    Attributes:
+    - max_rate: float
+    - min_rate: float
+    - increase: float
+    - capacity: float
+    - state_path: str
+    """
+
+    def __init__(self, rate_per_minute, capacity=None, state_path=None, min_rate_per_minute=None,
+                 increase_fraction=AIMD_INCREASE_FRACTION):
+        self.max_rate = rate_per_minute / 60.0
+        self.min_rate = (min_rate_per_minute or rate_per_minute * AIMD_MIN_RATE_FRACTION) / 60.0
+        self.increase = self.max_rate * increase_fraction
+        self.capacity = capacity if capacity is not None else max(1.0, self.max_rate)
+        self.state_path = state_path
+        self.state = self._new_state()
+        self.lock = threading.Lock()
+
+        if self.state_path:
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+
+    def _new_state(self):
+        return {"tokens": self.capacity, "updated_at": time.time(), "rate": self.max_rate, "blocked_until": 0.0}
+
+    def _update(self, update):
+        """
+        Applies `update(state)` to the bucket state with mutual exclusion
+        between threads and, with `state_path`, between processes.
+        Returns the result of `update`.
+        """
+        if not self.state_path:
+            with self.lock:
+                return update(self.state)
+
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                content = f.read()
+                state = self._new_state()
+                state.update(json.loads(content) if content else {})
+                result = update(state)
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+    def _take(self, state):
+        """
+        Refills the tokens since the last update and tries to take one.
+        Returns how many seconds to wait (0 when a token was taken).
+        """
+        now = time.time()
+        if now < state["blocked_until"]:
+            return state["blocked_until"] - now
+
+        rate = min(self.max_rate, state["rate"])
+        state["tokens"] = min(self.capacity, state["tokens"] + max(0.0, now - state["updated_at"]) * rate)
+        state["updated_at"] = now
+
+        if state["tokens"] >= 1:
+            state["tokens"] -= 1
+            return 0.0
+        return (1 - state["tokens"]) / rate
+
+    def acquire(self):
+        """
+        Takes one token, waiting only as long as the refill requires.
+        """
+        while True:
+            wait = self._update(self._take)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def on_success(self):
+        """Additive rate increase after a successful request."""
+        def increase(state):
+            state["rate"] = min(self.max_rate, state["rate"] + self.increase)
+        self._update(increase)
+
+    def on_throttle(self, delay=None):
+        """Multiplicative rate decrease and a `delay` seconds pause for every consumer."""
+        def decrease(state):
+            state["rate"] = max(self.min_rate, state["rate"] * AIMD_DECREASE_FACTOR)
+            state["tokens"] = 0.0
+            self.pause_state(state, delay)
+        self._update(decrease)
+
+    def pause(self, delay):
+        """Pauses the bucket for `delay` seconds, without changing the rate."""
+        if delay:
+            self._update(lambda state: self.pause_state(state, delay))
+
+    @staticmethod
+    def pause_state(state, delay):
+        if delay:
+            state["blocked_until"] = max(state["blocked_until"], time.time() + delay)
+
+
+class PageCheckpoint:
+    """
+    Pagination checkpoint. Completed pages are appended to `{path}.jsonl`
+    (one page per line) and the last completed page, with the token of the
+    next one, is written atomically to `{path}.json`. A checkpoint is only
+    valid for the same `key` (ex.: the incremental filter) of the run that
+    created it.
+
+    Attributes:
+    - state_path: str
+    - pages_path: str
+    - key: str
+    """
+
+    def __init__(self, path, key):
+        self.state_path = f"{path}.json"
+        self.pages_path = f"{path}.jsonl"
+        self.key = key
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def resume(self):
+        """
+        Returns (last completed page, token of the next page). The token is
+        None when the pagination had finished. Without a valid checkpoint,
+        returns (0, None).
+        """
+        if not os.path.exists(self.state_path) or not os.path.exists(self.pages_path):
+            self.clear()
+            return 0, None
+
+        with open(self.state_path, "r") as f:
+            state = json.load(f)
+
+        if state.get("key") != self.key:
+            self.clear()
+            return 0, None
+
+        # Drops pages appended after the last checkpoint
+        with open(self.pages_path, "rb+") as f:
+            complete = all(f.readline() for _ in range(state["last_page"]))
+            f.truncate(f.tell())
+
+        if not complete:
+            self.clear()
+            return 0, None
+        return state["last_page"], state.get("next_token")
+
+    def saved_pages(self):
+        with open(self.pages_path, "r") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def save(self, page, items, next_token=None):
+        with open(self.pages_path, "a") as f:
+            f.write(json.dumps(items) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        write_json_atomic(self.state_path, {
+            "key": self.key,
+            "last_page": page,
+            "next_token": next_token
+        })
+
+    def clear(self):
+        for path in (self.state_path, self.pages_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class WatermarkStore:
+    """
+    Stores the watermark of the incremental loads (ex.: the greatest
+    'updated_at' loaded) in a JSON file: {"last_update": "2024-12-27T10:46:28Z"}.
+
+    Attributes:
+    - path: str
+    - logger: logging.Logger
+    """
+
+    def __init__(self, path, logger=logger):
+        self.path = path
+        self.logger = logger
+
+    def get(self):
+        """
+        Returns the saved watermark, or None when there is none (full load).
+        """
+        if not os.path.exists(self.path):
+            self.logger.info(f"[WatermarkStore] File {self.path} not found. Returning None.")
+            return None
+
+        try:
+            with open(self.path, "r") as f:
+                last_update = json.load(f).get("last_update")
+            self.logger.info(f"[WatermarkStore] Loaded last_update {last_update}")
+            return last_update
+        except Exception as e:
+            self.logger.error(f"[WatermarkStore] Error loading file {self.path}: {e}")
+            return None
+
+    def save(self, last_update):
+        write_json_atomic(self.path, {"last_update": last_update})
+        self.logger.info(f"[WatermarkStore] Saved '{last_update}' to {self.path}.")
+
+
+class Pagination:
+    """
+    Pagination strategy. A page is requested with `params(token)` and
+    `next_token` returns the token of the following page, or None after the
+    last one. Strategies that know the number of pages up front implement
+    `page_count`, which lets the extractor fetch the remaining pages
+    concurrently.
+
+    Attributes:
+    - items_key: str, dotted path of the records in the response body
+    - first_token
+    """
+
+    first_token = 1
+
+    def __init__(self, items_key="data"):
+        self.items_key = items_key
+
+    def params(self, token):
+        raise NotImplementedError
+
+    def items(self, data):
+        return get_path(data, self.items_key) or []
+
+    def next_token(self, token, data, items):
+        raise NotImplementedError
+
+    def page_count(self, data):
+        return None
+
+
+class PageNumberPagination(Pagination):
+    """Numbered pages, until a page returns fewer than `per_page` records (or none)."""
+
+    def __init__(self, page_param="page", size_param=None, per_page=None, items_key="data"):
+        super().__init__(items_key)
+        self.page_param = page_param
+        self.size_param = size_param
+        self.per_page = per_page
+
+    def params(self, token):
+        params = {self.page_param: token}
+        if self.size_param:
+            params[self.size_param] = self.per_page
+        return params
+
+    def next_token(self, token, data, items):
+        if not items or (self.per_page and len(items) < self.per_page):
+            return None
+        return token + 1
+
+
+class HasNextPagination(PageNumberPagination):
+    """Numbered pages, while the response flag `has_next_key` is true."""
+
+    def __init__(self, page_param="page", has_next_key="hasNext", items_key="items", **kwargs):
+        super().__init__(page_param, items_key=items_key, **kwargs)
+        self.has_next_key = has_next_key
+
+    def next_token(self, token, data, items):
+        return token + 1 if get_path(data, self.has_next_key) else None
+
+
+class TotalCountPagination(PageNumberPagination):
+    """Numbered pages, until `per_page * page` reaches the total reported at `total_key`."""
+
+    def __init__(self, page_param="page", size_param="per_page", per_page=50, total_key="meta.total",
+                 items_key="data"):
+        super().__init__(page_param, size_param, per_page, items_key)
+        self.total_key = total_key
+
+    def total(self, data):
+        return get_path(data, self.total_key) or 0
+
+    def next_token(self, token, data, items):
+        return token + 1 if self.per_page * token < self.total(data) else None
+
+    def page_count(self, data):
+        return math.ceil(self.total(data) / self.per_page)
+
+
+class CursorPagination(Pagination):
+    """Opaque cursors: the response carries the cursor of the next page at `cursor_key`."""
+
+    first_token = None
+
+    def __init__(self, cursor_param="cursor", cursor_key="meta.next_cursor", items_key="data"):
+        super().__init__(items_key)
+        self.cursor_param = cursor_param
+        self.cursor_key = cursor_key
+
+    def params(self, token):
+        return {self.cursor_param: token} if token else {}
+
+    def next_token(self, token, data, items):
+        return get_path(data, self.cursor_key) or None
+
+
+class RestExtractor:
+    """
+    Paginates a REST endpoint through a shared session and rate limiter,
+    retrying the throttled requests and checkpointing every completed page.
+
+    Attributes:
+    - session: requests.Session
+    - rate_limiter: TokenBucket
+    - logger: logging.Logger
+    """
+
+    def __init__(self, session=None, rate_limiter=None, logger=logger):
+        self.session = session or get_http_session()
+        self.rate_limiter = rate_limiter
+        self.logger = logger
+
+    def request(self, url, params=None, headers=None, label=""):
+        """
+        GETs one page, retrying it while the server throttles us.
+        Returns the decoded response body.
+        """
+        attempt = 0
+
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            response = self.session.get(url, headers=headers, params=params)
+
+            # Throttled by the server: slow down, wait and retry the same page
+            if response.status_code in THROTTLE_STATUS_CODES and attempt < MAX_RETRIES:
+                delay = throttle_delay(response, attempt)
+                self.logger.warning(
+                    f"[request] {label}: HTTP {response.status_code} for {params}. Retrying in {delay:.1f}s")
+                if self.rate_limiter:
+                    self.rate_limiter.on_throttle(delay)
+                else:
+                    time.sleep(delay)
+                attempt += 1
+                continue
+
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError as e:
+                self.logger.error(f"[request] {label}: request failed for {params}: {e}")
+                self.logger.error(f"[request] Server response: {response.text}")
+                raise
+
+            if self.rate_limiter:
+                self.rate_limiter.on_success()
+                self.rate_limiter.pause(rate_limit_reset_delay(response))
+            return response.json()
+
+    def extract(self, url, pagination, params=None, headers=None, checkpoint=None, on_page=None,
+                max_workers=1, label=""):
+        """
+        Fetches every page of `url` with the `pagination` strategy.
+        Returns the list of records in page order; when `on_page` is given,
+        each page is handed to it as soon as it arrives and nothing is kept
+        in memory.
+        With a `checkpoint`, every completed page is saved and a failed run
+        is resumed from the next page. With `max_workers` > 1 and a strategy
+        that knows the number of pages, the remaining pages are fetched by up
+        to `max_workers` threads after the first one.
+        """
+        all_items = []
+
+        def emit(items):
+            if on_page is not None:
+                on_page(items)
+            else:
+                all_items.extend(items)
+
+        def fetch(token):
+            return self.request(url, params={**(params or {}), **pagination.params(token)},
+                                headers=headers, label=label)
+
+        def save(page, items, next_token):
+            if checkpoint:
+                checkpoint.save(page, items, next_token)
+            emit(items)
+            self.logger.info(f"[extract] {label}: page {page} returned {len(items)} records")
+
+        page, token = checkpoint.resume() if checkpoint else (0, None)
+        if page:
+            self.logger.info(f"[extract] {label}: resuming from checkpoint after page {page}")
+            for items in checkpoint.saved_pages():
+                emit(items)
+            if token is None:
+                return all_items
+        else:
+            token = pagination.first_token
+
+        while True:
+            data = fetch(token)
+            items = pagination.items(data)
+            token = pagination.next_token(token, data, items)
+            page += 1
+            save(page, items, token)
+
+            if token is None:
+                break
+
+            page_count = pagination.page_count(data) if max_workers > 1 else None
+            if page_count:
+                # Pages complete out of order, but map() yields them in order, so
+                # the checkpoint always covers a contiguous run of pages
+                remaining = range(token, page_count + 1)
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    for next_page, data in zip(remaining, executor.map(fetch, remaining)):
+                        page = next_page
+                        save(page, pagination.items(data), page + 1 if page < page_count else None)
+                break
+
+        return all_items
+
+
+class ParquetPartitionWriter:
+    """
+    Batched sink that writes Arrow tables to local Parquet files, one per day
+    of `partition_column` (`{file_prefix}_{date}.parquet`). Every `write`
+    appends a row group to the files of its days, so memory stays bounded by
+    the size of a page.
+
+    Attributes:
+    - schema: pa.Schema
+    - directory: str
+    - partition_column: str
+    - file_prefix: str
+    - row_group_size: int
+    """
+
+    def __init__(self, schema, directory, partition_column, file_prefix, row_group_size=None,
+                 compression=PARQUET_COMPRESSION):
+        self.schema = schema
+        self.directory = directory
+        self.partition_column = partition_column
+        self.file_prefix = file_prefix
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.writers = {}
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def write(self, table):
+        dates = pc.cast(table[self.partition_column], pa.date32())
+
+        with self.lock:
+            for date in pc.unique(dates).to_pylist():
+                if date is None:
+                    continue
+
+                if date not in self.writers:
+                    self.paths[date] = os.path.join(self.directory, f"{self.file_prefix}_{date}.parquet")
+                    self.writers[date] = pq.ParquetWriter(self.paths[date], self.schema, compression=self.compression)
+
+                self.writers[date].write_table(
+                    table.filter(pc.equal(dates, pa.scalar(date, pa.date32()))),
+                    row_group_size=self.row_group_size
+                )
+
+    def close(self):
+        """
+        Closes every file and returns a dict {date: file path}.
+        """
+        with self.lock:
+            for writer in self.writers.values():
+                writer.close()
+            self.writers = {}
+        return self.paths
+
+
+def parse_timestamp(value):
+    """
+    Parses an ISO 8601 string (ex.: "2024-12-27T10:46:28Z") to an aware
+    datetime, or returns None when the value is not a timestamp.
+    """
+    if len(value) < 19 or value[10:11] != "T":
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def update_record_types(types, variant_columns, records):
+    """
+    Updates, in place, the type inferred for every field of the records (an
+    Arrow type per field name, None while only nulls were seen) and the set of
+    VARIANT fields. Nested (dict/list) fields and fields with mixed types are
+    VARIANT. String fields holding only ISO 8601 values are typed as timestamps.
+    """
+    timestamp = pa.timestamp("us", tz="UTC")
+
+    for record in records:
+        for key, value in record.items():
+            if value is None:
+                types.setdefault(key, None)
+                continue
+            if isinstance(value, (dict, list)):
+                variant_columns.add(key)
+                types.setdefault(key, None)
+                continue
+
+            if isinstance(value, bool):
+                arrow_type = pa.bool_()
+            elif isinstance(value, int):
+                arrow_type = pa.int64()
+            elif isinstance(value, float):
+                arrow_type = pa.float64()
+            elif parse_timestamp(value):
+                arrow_type = timestamp
+            else:
+                arrow_type = pa.string()
+
+            if types.get(key) is None:
+                types[key] = arrow_type
+            elif {types[key], arrow_type} == {pa.string(), timestamp}:
+                types[key] = pa.string()
+            elif types[key] != arrow_type:
+                variant_columns.add(key)
+
+
+class SnowflakeStageWriter:
+    """
+    Batched sink that stages records in a Snowflake temporary stage without
+    keeping them in memory. Every `write` (ex.: one API page) is appended as a
+    row group to a local Parquet file with a fixed schema, a single JSON text
+    column, and a new file is started every `chunk_size` records. Only the
+    type of each field is kept (`update_record_types`). `close` PUTs the files
+    in the stage and returns a Snowpark DataFrame reading them with one column
+    per field, the nested and mixed-type fields as VARIANT.
+
+    Attributes:
+    - snowpark: snowflake.snowpark.Session
+    - stage: str
+    - path: str
+    - chunk_size: int
+    - count: int, records written so far
+    """
+
+    schema = pa.schema([("record", pa.string())])
+
+    def __init__(self, snowpark, stage, path, chunk_size=STAGE_CHUNK_SIZE, logger=logger):
+        self.snowpark = snowpark
+        self.stage = stage
+        self.path = path
+        self.chunk_size = chunk_size
+        self.logger = logger
+        self.directory = tempfile.TemporaryDirectory()
+        self.writer = None
+        self.files = 0
+        self.file_rows = 0
+        self.count = 0
+        self.types = {}
+        self.variant_columns = set()
+        self.lock = threading.Lock()
+
+    def write(self, records):
+        if not records:
+            return
+
+        table = pa.Table.from_arrays([pa.array([json.dumps(record) for record in records], pa.string())],
+                                     schema=self.schema)
+        with self.lock:
+            update_record_types(self.types, self.variant_columns, records)
+
+            if self.writer is None or self.file_rows >= self.chunk_size:
+                self._close_file()
+                path = os.path.join(self.directory.name, f"records_{self.files:05d}.parquet")
+                self.writer = pq.ParquetWriter(path, self.schema, compression="snappy")
+                self.files += 1
+
+            self.writer.write_table(table)
+            self.file_rows += table.num_rows
+            self.count += table.num_rows
+
+    def _close_file(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.file_rows = 0
+
+    def column(self, record, name):
+        """Snowpark expression reading the field `name` of the staged JSON record with its inferred type."""
+        from snowflake.snowpark.functions import to_timestamp
+        from snowflake.snowpark.types import BooleanType, DoubleType, LongType, StringType
+
+        value = record[name]
+        arrow_type = self.types[name]
+        if name in self.variant_columns:
+            return value
+        if arrow_type is None or pa.types.is_string(arrow_type):
+            return value.cast(StringType())
+        if pa.types.is_timestamp(arrow_type):
+            return to_timestamp(value.cast(StringType()))
+        if pa.types.is_boolean(arrow_type):
+            return value.cast(BooleanType())
+        if pa.types.is_integer(arrow_type):
+            return value.cast(LongType())
+        return value.cast(DoubleType())
+
+    def close(self):
+        """
+        Returns the Snowpark DataFrame of the staged records, or None when no
+        record was written.
+        """
+        stage_path = f"@{self.stage}/{self.path}"
+        try:
+            with self.lock:
+                self._close_file()
+
+            if not self.files:
+                self.logger.info("[SnowflakeStageWriter] No records to stage.")
+                return None
+
+            self.snowpark.sql(f"create or replace temporary stage {self.stage}").collect()
+            self.logger.info(
+                f"[SnowflakeStageWriter] Putting {self.files} Parquet files ({self.count} records) into {stage_path}")
+            self.snowpark.sql(
+                f"PUT file://{self.directory.name}/*.parquet {stage_path} PARALLEL=8 AUTO_COMPRESS=FALSE").collect()
+        finally:
+            self.directory.cleanup()
+
+        from snowflake.snowpark.functions import col, parse_json
+
+        record = parse_json(col('"record"'))
+        staged = self.snowpark.read.parquet(stage_path)
+        return staged.select([self.column(record, name).alias(name) for name in self.types])
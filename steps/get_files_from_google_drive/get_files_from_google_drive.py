@@ -6,10 +6,13 @@ from pathlib import Path
 from typing import List, Dict
 from google.oauth2 import service_account
 from googleapiclient.discovery import Resource, build
+from googleapiclient.http import MediaIoBaseDownload
 
 
 ORCHEST_STEP_UUID = os.environ.get("ORCHEST_STEP_UUID")
 SCOPES = ["https://www.googleapis.com/auth/drive"]
+# Chunk size (bytes) when streaming a file to the spool directory
+SPOOL_CHUNK_SIZE = 8 * 1024 * 1024
 
 
 logging.basicConfig(
@@ -45,7 +48,47 @@ def authenticate_google_drive(service_account_file: Path) -> Resource:
     return service
 
 
-def list_files_in_folder(service: Resource, selected_folder_id: str) -> List[Dict]:
+def spool_file(service: Resource, file: Dict, spool_directory: str) -> Dict:
+    """
+    Streams a Google Drive file to the spool directory, in chunks.
+
+    Parameters
+    ----------
+    service: Resource
+        Google Drive service account.
+    file: Dict
+        File metadata (id, name and, for binary files, md5Checksum).
+    spool_directory: str
+        Local directory where the file is saved.
+
+    Returns
+    -------
+    entry: Dict
+        Manifest entry with file_name, file_path, size, key (file id) and etag (md5).
+    """
+
+    # Drive allows files with the same name in a folder: the id keeps their paths apart
+    file_path = os.path.join(spool_directory, f"{file['id']}_{os.path.basename(file['name'])}")
+    request = service.files().get_media(fileId=file["id"])
+
+    with open(file_path, "wb") as f:
+        downloader = MediaIoBaseDownload(f, request, chunksize=SPOOL_CHUNK_SIZE)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk()
+
+    return {
+        "file_name": file["name"],
+        "file_path": file_path,
+        "size": os.path.getsize(file_path),
+        "key": file["id"],
+        "etag": file.get("md5Checksum"),
+    }
+
+
+def list_files_in_folder(
+    service: Resource, selected_folder_id: str, spool_directory: str = None
+) -> List[Dict]:
     """
     Gets all files in selected Google Drive folder.
 
@@ -55,6 +98,9 @@ def list_files_in_folder(service: Resource, selected_folder_id: str) -> List[Dic
         Google Drive service account.
     selected_folder_id: str
         Selected Google Drive folder ID.
+    spool_directory: str
+        Optional local directory. When given, the files are streamed there and
+        only their manifest entries are returned ("by reference" mode).
 
     Returns
     -------
@@ -67,7 +113,7 @@ def list_files_in_folder(service: Resource, selected_folder_id: str) -> List[Dic
         .list(
             q=f"'{selected_folder_id}' in parents and trashed=false",
             pageSize=10,
-            fields="nextPageToken, files(id, name)",
+            fields="nextPageToken, files(id, name, md5Checksum)",
         )
         .execute()
     )
@@ -75,6 +121,10 @@ def list_files_in_folder(service: Resource, selected_folder_id: str) -> List[Dic
     logger.info(f"Selected folder id {selected_folder_id}")
     files = results.get("files", [])
 
+    if spool_directory:
+        os.makedirs(spool_directory, exist_ok=True)
+        return [spool_file(service, file, spool_directory) for file in files]
+
     outputs = []
     for file in files:
         file_name = file["name"]
@@ -94,9 +144,10 @@ def orchest_handler():
     service_account_file = orchest.get_step_param("service_account_file")
     selected_folder_id = orchest.get_step_param("selected_folder_id")
     outgoing_variable_name = orchest.get_step_param("outgoing_variable_name")
+    spool_directory = orchest.get_step_param("spool_directory")
 
     service = authenticate_google_drive(service_account_file)
-    outputs = list_files_in_folder(service, selected_folder_id)
+    outputs = list_files_in_folder(service, selected_folder_id, spool_directory)
 
     orchest.output(data=outputs, name=outgoing_variable_name)
 
@@ -1,11 +1,23 @@
 import boto3
-from typing import Dict, Union
+from botocore.config import Config
+from typing import Dict, Iterator, List, Union
+from collections import deque
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import os
 import sys
 import json
+import gzip
+import shutil
+import tempfile
 from dadosfera.services.s3 import list_s3_objects
 import logging
 import chardet
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
 
 ORCHEST_STEP_UUID = os.environ.get('ORCHEST_STEP_UUID')
 
@@ -15,44 +27,447 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-def get_objects_from_s3(bucket_name: str, prefix: str) -> Union[Dict[str, str], None]:
-    client = boto3.client('s3', region_name='us-east-1')
+# Default cap (MB) on the combined size of the objects downloaded but not yet consumed
+MAX_INFLIGHT_MB = 256
+# Read size (bytes) when streaming a body to the spool directory
+SPOOL_CHUNK_SIZE = 8 * 1024 * 1024
+# Objects of at least RANGE_THRESHOLD_MB are fetched as RANGE_PART_MB byte ranges,
+# RANGE_WORKERS at a time
+RANGE_THRESHOLD_MB = 64
+RANGE_PART_MB = 16
+RANGE_WORKERS = 8
+# Key suffixes of compressed objects, decompressed while they are downloaded
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd'}
+# Parquet read mode: operators accepted in the filters
+PARQUET_FILTER_OPERATORS = {
+    '=': lambda field, value: field == value,
+    '==': lambda field, value: field == value,
+    '!=': lambda field, value: field != value,
+    '<': lambda field, value: field < value,
+    '<=': lambda field, value: field <= value,
+    '>': lambda field, value: field > value,
+    '>=': lambda field, value: field >= value,
+    'in': lambda field, value: field.isin(value),
+    'not in': lambda field, value: ~field.isin(value)
+}
+
+
+def spool_path(spool_directory: str, key: str) -> str:
+    """Local path of a spooled object: the key layout below spool_directory."""
+    parts = [part for part in key.split('/') if part not in ('', '.', '..')]
+    return os.path.join(spool_directory, *parts)
+
+
+def object_compression(key: str, content_encoding: str = None) -> Union[str, None]:
+    """Compression of an object, from its ContentEncoding or else its key suffix."""
+    content_encoding = (content_encoding or '').lower()
+    for compression in COMPRESSION_SUFFIXES.values():
+        if compression in content_encoding:
+            return compression
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if key.endswith(suffix):
+            return compression
+    return None
+
+
+def decompressed_stream(stream, compression: str):
+    """Readable stream with the decompressed contents of `stream`, decompressed as it is read."""
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise ValueError(f"Unsupported compression '{compression}'")
+
+
+def decompress_spooled(file_path: str, compression: str) -> int:
+    """Decompresses a spooled file in place (through a temporary file). Returns its new size."""
+    directory = os.path.dirname(file_path)
+    with open(file_path, 'rb') as source, tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as f:
+        shutil.copyfileobj(decompressed_stream(source, compression), f, SPOOL_CHUNK_SIZE)
+        size = f.tell()
+    os.replace(f.name, file_path)
+    return size
+
+
+def get_object_ranges(
+        client,
+        bucket_name: str,
+        object_metadata: Dict,
+        spool_directory: str = None,
+        range_part_mb: int = RANGE_PART_MB,
+        range_workers: int = RANGE_WORKERS,
+        decompress: bool = False
+    ) -> Dict[str, str]:
+    """
+    Downloads a large object as concurrent byte ranges, each written at its
+    offset in a preallocated local file (spool_directory) or in-memory buffer.
+    Every range is requested with IfMatch on the listed ETag, so the parts
+    cannot come from different versions of the object. Objects stored with a
+    gzip/zstd ContentEncoding are decompressed once all ranges arrived.
+    In memory, file_content is the preallocated bytearray itself: copying it to
+    bytes would hold the object twice.
+    """
+    key = object_metadata['Key']
+    size = object_metadata['Size']
+    etag = object_metadata['ETag']
+    part_size = range_part_mb * 1024 * 1024
+    content_encodings = set()
+
+    if spool_directory:
+        file_path = spool_path(spool_directory, key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.truncate(size)
+        fd = os.open(file_path, os.O_WRONLY)
+    else:
+        buffer = bytearray(size)
+
+    def fetch_range(start):
+        end = min(start + part_size, size) - 1
+        response = client.get_object(Bucket=bucket_name, Key=key, Range=f'bytes={start}-{end}', IfMatch=etag)
+        content_encodings.add(response.get('ContentEncoding'))
+        body = response['Body'].read()
+        if spool_directory:
+            os.pwrite(fd, body, start)
+        else:
+            buffer[start:start + len(body)] = body
+
+    logger.info(f"Downloading {key} ({size} bytes) as {range_part_mb} MB ranges")
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, range_workers)) as executor:
+            list(executor.map(fetch_range, range(0, size, part_size)))
+    finally:
+        if spool_directory:
+            os.close(fd)
+
+    compression = object_compression(key, content_encodings.pop()) if decompress else None
+    if compression:
+        logger.info(f"Decompressing {key} ({compression})")
+        if spool_directory:
+            size = decompress_spooled(file_path, compression)
+        else:
+            buffer = decompressed_stream(BytesIO(buffer), compression).read()
+
+    if spool_directory:
+        return {
+            'file_path': file_path,
+            'size': size,
+            'key': key,
+            'etag': etag.strip('"'),
+            'file_name': key.split('/')[-1].split('.')[0]
+        }
+
+    return {
+        'file_content': buffer,
+        'key': key,
+        'file_name': key.split('/')[-1].split('.')[0]
+    }
+
+
+def get_object(
+        client,
+        bucket_name: str,
+        object_metadata: Dict,
+        spool_directory: str = None,
+        range_options: Dict = None,
+        decompress: bool = False
+    ) -> Union[Dict[str, str], None]:
+    """
+    Downloads an object. With spool_directory, the body is streamed to a local
+    file and a manifest entry (file_path, size, key, etag) is returned instead
+    of the content. Objects of at least range_threshold_mb (see range_options)
+    are downloaded by get_object_ranges, except .gz/.zst ones, which are
+    streamed through the decompressor instead of being held compressed.
+    With decompress, gzip/zstd objects (by ContentEncoding or key suffix) are
+    returned decompressed.
+    """
+    key = object_metadata['Key']
+    range_options = dict(range_options or {})
+    range_threshold_mb = range_options.pop('range_threshold_mb', RANGE_THRESHOLD_MB)
+    streamed = decompress and object_compression(key) is not None
+    if range_threshold_mb and not streamed and object_metadata.get('Size', 0) >= range_threshold_mb * 1024 * 1024:
+        return get_object_ranges(client, bucket_name, object_metadata, spool_directory, decompress=decompress,
+                                 **range_options)
+
+    response = client.get_object(Bucket=bucket_name, Key=key)
+    if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+        return None
+
+    body = response['Body']
+    compression = object_compression(key, response.get('ContentEncoding')) if decompress else None
+    if compression:
+        body = decompressed_stream(body, compression)
+
+    if spool_directory:
+        file_path = spool_path(spool_directory, key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            shutil.copyfileobj(body, f, SPOOL_CHUNK_SIZE)
+            size = f.tell()
+        return {
+            'file_path': file_path,
+            'size': size,
+            'key': key,
+            'etag': response['ETag'].strip('"'),
+            'file_name': key.split('/')[-1].split('.')[0]
+        }
+
+    return {
+        'file_content': body.read(),
+        'key': key,
+        'file_name': key.split('/')[-1].split('.')[0]
+    }
+
+
+def load_manifest(manifest_path: str) -> Dict[str, list]:
+    """
+    Loads the sync manifest: {key: [etag, last_modified, size]} of the objects
+    already delivered. Returns an empty manifest on the first run.
+    """
+    if not os.path.exists(manifest_path):
+        logger.info(f"Manifest {manifest_path} not found. Syncing the whole prefix")
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path: str, manifest: Dict[str, list]) -> None:
+    """Writes the manifest to a temporary file and renames it over the previous one."""
+    directory = os.path.dirname(manifest_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(f.name, manifest_path)
+    logger.info(f"Manifest {manifest_path} saved with {len(manifest)} objects")
+
+
+def manifest_entry(object_metadata: Dict) -> list:
+    return [
+        object_metadata['ETag'].strip('"'),
+        object_metadata['LastModified'].isoformat(),
+        object_metadata['Size']
+    ]
+
+
+def list_changed_objects(client, bucket_name: str, prefix: str, manifest: Dict[str, list],
+                         append_only: bool = False) -> list:
+    """
+    Lists the objects under the prefix that are new or changed since the
+    manifest. With append_only, listing starts after the greatest key already
+    in the manifest (StartAfter), so only the new keys are listed at all.
+    """
+    params = {'Bucket': bucket_name, 'Prefix': prefix}
+    if append_only and manifest:
+        params['StartAfter'] = max(manifest)
+
+    objects_metadata = []
+    for page in client.get_paginator('list_objects_v2').paginate(**params):
+        for object_metadata in page.get('Contents', []):
+            if manifest.get(object_metadata['Key']) != manifest_entry(object_metadata):
+                objects_metadata.append(object_metadata)
+    return objects_metadata
+
+
+def iter_objects_from_s3(
+        bucket_name: str,
+        prefix: str,
+        max_workers: int = 1,
+        max_pool_connections: int = None,
+        max_inflight_mb: int = MAX_INFLIGHT_MB,
+        spool_directory: str = None,
+        manifest: Dict[str, list] = None,
+        append_only: bool = False,
+        range_threshold_mb: int = RANGE_THRESHOLD_MB,
+        range_part_mb: int = RANGE_PART_MB,
+        range_workers: int = RANGE_WORKERS,
+        decompress: bool = False
+    ) -> Iterator[Dict[str, str]]:
+    """
+    Downloads the objects under the prefix with up to `max_workers` threads and
+    yields them in listing order. A new download only starts while the objects
+    downloaded but not yet consumed add up to less than `max_inflight_mb`, so
+    memory stays bounded whatever the concurrency (a single object larger than
+    the cap is still downloaded, alone).
+    With spool_directory ("by reference" mode), the bodies are streamed to
+    files in that directory and only their manifest entries are yielded.
+    With a sync manifest (see load_manifest), only the new or changed objects
+    are downloaded and the manifest is updated as each of them is yielded.
+    Objects of at least range_threshold_mb are downloaded as range_workers
+    concurrent byte ranges of range_part_mb (0 disables it). The ranges run
+    inside the object workers, so the connection pool defaults to
+    max_workers * range_workers (at least 10).
+    With decompress (off by default, so .gz/.zst objects keep their bytes),
+    gzip/zstd objects are decompressed while they are downloaded. The
+    in-flight cap counts their compressed size, so keep max_inflight_mb
+    below the memory limit divided by the compression ratio.
+    """
+    max_workers = max(1, max_workers)
+    range_options = {
+        'range_threshold_mb': range_threshold_mb,
+        'range_part_mb': range_part_mb,
+        'range_workers': range_workers
+    }
+    client = boto3.client(
+        's3',
+        region_name='us-east-1',
+        config=Config(max_pool_connections=max_pool_connections or max(10, max_workers * max(1, range_workers)))
+    )
 
     logger.info(f"Listing objects in bucket {bucket_name} for prefix {prefix}")
-    objects_metadata = list_s3_objects(bucket_name=bucket_name, prefix=prefix)
-    logger.info(f"Found {len(objects_metadata)} objects")
+    if manifest is None:
+        objects_metadata = list_s3_objects(bucket_name=bucket_name, prefix=prefix)
+        logger.info(f"Found {len(objects_metadata)} objects")
+    else:
+        objects_metadata = list_changed_objects(client, bucket_name, prefix, manifest, append_only)
+        logger.info(f"Found {len(objects_metadata)} new or changed objects")
+
+    max_inflight_bytes = max_inflight_mb * 1024 * 1024
+    inflight_bytes = 0
+    pending = deque()
+
+    def deliver(future, object_metadata):
+        obj = future.result()
+        if obj is not None and manifest is not None:
+            manifest[object_metadata['Key']] = manifest_entry(object_metadata)
+        return obj
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for object_metadata in objects_metadata:
+            # Spooled bodies go to disk and do not count towards the cap
+            size = 0 if spool_directory else object_metadata.get('Size', 0)
+
+            # Hands over the oldest downloads until the new one fits in the cap
+            while pending and inflight_bytes + size > max_inflight_bytes:
+                future, pending_size, pending_metadata = pending.popleft()
+                obj = deliver(future, pending_metadata)
+                if obj is not None:
+                    yield obj
+                inflight_bytes -= pending_size
+
+            future = executor.submit(get_object, client, bucket_name, object_metadata, spool_directory,
+                                     range_options, decompress)
+            pending.append((future, size, object_metadata))
+            inflight_bytes += size
 
+        while pending:
+            future, _, pending_metadata = pending.popleft()
+            obj = deliver(future, pending_metadata)
+            if obj is not None:
+                yield obj
 
-    objects = []
-    for object_metadata in objects_metadata:
-        response = client.get_object(Bucket=bucket_name, Key=object_metadata['Key'])
-        if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-            body = response['Body'].read()
-            objects.append({
-                'file_content': body,
-                'key': object_metadata['Key'],
-                'file_name': object_metadata['Key'].split('/')[-1].split('.')[0]
-            })
 
-    return objects
+def parquet_filter_expression(filters: List[Dict], schema: pa.Schema) -> Union[ds.Expression, None]:
+    """
+    Builds a dataset filter from conditions like
+    {"column": "DataExtracao", "op": ">=", "value": "2024-01-01"}, combined
+    with AND. Values are cast to the column type, so dates and timestamps can
+    be given as text.
+    """
+    expression = None
+    for condition in filters or []:
+        column, op, value = condition['column'], condition.get('op', '='), condition['value']
+        if op not in PARQUET_FILTER_OPERATORS:
+            raise ValueError(f"Unsupported filter operator '{op}'. Use one of {list(PARQUET_FILTER_OPERATORS)}")
+
+        field_type = schema.field(column).type
+        if op in ('in', 'not in'):
+            value = pa.array(value).cast(field_type)
+        else:
+            value = pa.scalar(value).cast(field_type)
+
+        condition_expression = PARQUET_FILTER_OPERATORS[op](pc.field(column), value)
+        expression = condition_expression if expression is None else expression & condition_expression
+    return expression
+
+
+def read_parquet_from_s3(
+        bucket_name: str,
+        prefix: str,
+        columns: List[str] = None,
+        filters: List[Dict] = None,
+        hive_partitioning: bool = False
+    ) -> pa.Table:
+    """
+    Reads the Parquet files under the prefix as one dataset. Only the requested
+    columns are read, and row groups (and hive partitions) whose statistics
+    cannot match the filters are skipped without being downloaded.
+    """
+    dataset = ds.dataset(
+        f"{bucket_name}/{prefix}".rstrip('/'),
+        filesystem=fs.S3FileSystem(region='us-east-1'),
+        format='parquet',
+        partitioning='hive' if hive_partitioning else None
+    )
+    table = dataset.to_table(columns=columns or None, filter=parquet_filter_expression(filters, dataset.schema))
+    logger.info(f"Read {table.num_rows} rows and {table.num_columns} columns from s3://{bucket_name}/{prefix}")
+    return table
+
+
+def get_objects_from_s3(bucket_name: str, prefix: str, **download_options) -> Union[Dict[str, str], None]:
+    return list(iter_objects_from_s3(bucket_name=bucket_name, prefix=prefix, **download_options))
+
+
+def write_objects(objects: Iterator[Dict[str, str]], output_filepath: str) -> None:
+    """Writes the objects as a JSON list, one at a time, as they are downloaded."""
+    with open(output_filepath, 'w') as f:
+        f.write('[')
+        for index, obj in enumerate(objects):
+            if index:
+                f.write(', ')
+            f.write(json.dumps(obj))
+        f.write(']')
 
 def orchest_handler():
     import orchest
     bucket_name = orchest.get_step_param('bucket_name')
     prefix = orchest.get_step_param('prefix')
     output_type = orchest.get_step_param('output_type')
+    read_mode = orchest.get_step_param('read_mode') or 'objects'
     if prefix is None:
         prefix = ''
 
-    objects = get_objects_from_s3(bucket_name=bucket_name, prefix=prefix)
+    if read_mode == 'parquet':
+        table = read_parquet_from_s3(
+            bucket_name=bucket_name,
+            prefix=prefix,
+            columns=orchest.get_step_param('parquet_columns'),
+            filters=orchest.get_step_param('parquet_filters'),
+            hive_partitioning=bool(orchest.get_step_param('hive_partitioning'))
+        )
+        if output_type == 'to_outgoing_variable':
+            orchest.output(data=table, name=orchest.get_step_param('output_variable_name'))
+        elif output_type == 'to_filepath':
+            pq.write_table(table, orchest.get_step_param('output_filepath'))
+        return
+
+    range_threshold_mb = orchest.get_step_param('range_threshold_mb')
+    download_options = {
+        'max_workers': orchest.get_step_param('max_workers') or 1,
+        'max_pool_connections': orchest.get_step_param('max_pool_connections'),
+        'max_inflight_mb': orchest.get_step_param('max_inflight_mb') or MAX_INFLIGHT_MB,
+        'spool_directory': orchest.get_step_param('spool_directory'),
+        'append_only': bool(orchest.get_step_param('append_only')),
+        'range_threshold_mb': RANGE_THRESHOLD_MB if range_threshold_mb is None else range_threshold_mb,
+        'range_part_mb': orchest.get_step_param('range_part_mb') or RANGE_PART_MB,
+        'range_workers': orchest.get_step_param('range_workers') or RANGE_WORKERS,
+        'decompress': bool(orchest.get_step_param('decompress'))
+    }
+    manifest_path = orchest.get_step_param('manifest_path')
+    if manifest_path:
+        download_options['manifest'] = load_manifest(manifest_path)
 
     if output_type == 'to_outgoing_variable':
+        objects = get_objects_from_s3(bucket_name=bucket_name, prefix=prefix, **download_options)
         output_variable_name = orchest.get_step_param('output_variable_name')
         orchest.output(data=objects, name=output_variable_name)
     elif output_type == 'to_filepath':
         output_filepath = orchest.get_step_param('output_filepath')
-        with open(output_filepath,'w') as f:
-            f.write(json.dumps(objects))
+        write_objects(iter_objects_from_s3(bucket_name=bucket_name, prefix=prefix, **download_options), output_filepath)
+
+    # Only after the delta was handed over, so a failed run downloads it again
+    if manifest_path:
+        save_manifest(manifest_path, download_options['manifest'])
 
 def script_handler():
     if len(sys.argv) != 2:
@@ -63,10 +478,37 @@ def script_handler():
     bucket_name = config.get('bucket_name')
     prefix = config.get('prefix')
     output_filepath = config.get('output_filepath')
-    objects = get_objects_from_s3(bucket_name=bucket_name, prefix=prefix)
 
-    with open(output_filepath,'w') as f:
-        f.write(json.dumps(objects))
+    if config.get('read_mode', 'objects') == 'parquet':
+        table = read_parquet_from_s3(
+            bucket_name=bucket_name,
+            prefix=prefix or '',
+            columns=config.get('parquet_columns'),
+            filters=config.get('parquet_filters'),
+            hive_partitioning=config.get('hive_partitioning', False)
+        )
+        pq.write_table(table, output_filepath)
+        return
+
+    download_options = {
+        'max_workers': config.get('max_workers', 1),
+        'max_pool_connections': config.get('max_pool_connections'),
+        'max_inflight_mb': config.get('max_inflight_mb', MAX_INFLIGHT_MB),
+        'spool_directory': config.get('spool_directory'),
+        'append_only': config.get('append_only', False),
+        'range_threshold_mb': config.get('range_threshold_mb', RANGE_THRESHOLD_MB),
+        'range_part_mb': config.get('range_part_mb', RANGE_PART_MB),
+        'range_workers': config.get('range_workers', RANGE_WORKERS),
+        'decompress': config.get('decompress', False)
+    }
+    manifest_path = config.get('manifest_path')
+    if manifest_path:
+        download_options['manifest'] = load_manifest(manifest_path)
+
+    write_objects(iter_objects_from_s3(bucket_name=bucket_name, prefix=prefix, **download_options), output_filepath)
+
+    if manifest_path:
+        save_manifest(manifest_path, download_options['manifest'])
 
 
 if __name__ == "__main__":
@@ -1,9 +1,18 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, RawIOBase
 import json
+import base64
+import hashlib
+import tarfile
+import zlib
 import sys
 import os
 import logging
-from typing import Dict, Union, List
+from typing import Dict, Iterable, Iterator, Union, List
 
 ORCHEST_STEP_UUID = os.environ.get('ORCHEST_STEP_UUID')
 
@@ -13,43 +22,427 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-def put_objects_in_s3(
-    objects: List[str],
-    bucket_name: str,
-    prefix: str,
-    file_extension: str
-) -> Union[Dict[str, str], None]:
-    client = boto3.client('s3', region_name='us-east-1')
-
+# Transfer manager defaults: parts uploaded concurrently per object, size (MB)
+# from which an object is uploaded in parts, and size (MB) of each part
+MAX_CONCURRENCY = 10
+MULTIPART_THRESHOLD_MB = 8
+MULTIPART_CHUNKSIZE_MB = 8
+# Read size (bytes) when hashing a body to compare it with the ETag in S3
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+# Packing mode: formats and the maximum size (MB) of the contents of a bundle.
+# Bundles and indexes are named after a hash of their content
+PACK_FORMATS = ('jsonl', 'parquet', 'tar')
+BUNDLE_SIZE_MB = 128
+INDEX_FILE_PREFIX = '_index_'
+CONTENT_HASH_LENGTH = 16
+# Default cap (MB) on the combined size of the in-memory bodies (bundles included)
+# taken from the input and not uploaded yet
+MAX_INFLIGHT_MB = 256
+# from_filepath input: json (each file is one object's content, or the list of
+# objects in script mode), ndjson (one object or manifest entry per line) or
+# raw (each file is uploaded as it is, from disk)
+INPUT_FORMATS = ('json', 'ndjson', 'raw')
+# Compression: extension appended to the keys of compressed objects, and read
+# size (bytes) when compressing a body as it is uploaded
+COMPRESSION_EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+
+
+def object_key(object_: Dict, prefix: str, file_extension: str) -> str:
+    if file_extension is not None:
+        return f"{prefix}/{object_['file_name']}.{file_extension}"
+    return f"{prefix}/{object_['file_name']}"
+
+
+def is_spooled(object_: Dict) -> bool:
+    """Manifest entry ("by reference" mode): the body is in the spooled file_path."""
+    return 'file_content' not in object_ and 'file_path' in object_
+
+
+def inflight_size(object_: Dict) -> int:
+    """Bytes an object holds in memory until it is uploaded. Spooled bodies are on disk."""
+    if is_spooled(object_):
+        return 0
+    file_content = object_['file_content']
+    return len(file_content) if isinstance(file_content, (bytes, bytearray, str)) else 0
+
+
+def content_hash(content: Union[bytes, str]) -> str:
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()[:CONTENT_HASH_LENGTH]
+
+
+class BufferReader(RawIOBase):
+    """
+    Read-only stream over a bytes-like body, such as the bytearray of a ranged
+    download, that copies only what is read (BytesIO copies a bytearray whole).
+    """
+
+    def __init__(self, body):
+        self.view = memoryview(body)
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        size = min(len(b), len(self.view) - self.position)
+        b[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+def body_stream(body) -> RawIOBase:
+    return BytesIO(body) if isinstance(body, bytes) else BufferReader(body)
+
+
+def object_body(object_: Dict) -> bytes:
+    file_content = object_['file_content']
+    if isinstance(file_content, str):
+        file_content = file_content.encode('utf-8')
+
+    if isinstance(file_content, dict):
+        file_content = json.dumps(file_content).encode('utf-8')
+    return file_content
+
+
+class CompressedStream:
+    """
+    Read-only file object with the compressed contents of `source`, produced as
+    it is read, so a body is never held compressed in full. read(size) returns
+    exactly `size` bytes until the end of the stream, as the transfer manager
+    expects from non-seekable bodies.
+    """
+
+    def __init__(self, source, compression: str):
+        if compression == 'gzip':
+            # wbits=31 writes a gzip container with a fixed header (no mtime),
+            # so the same body always compresses to the same bytes (and ETag)
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif compression == 'zstd':
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            raise ValueError(f"compression must be one of {list(COMPRESSION_EXTENSIONS)}, got '{compression}'")
+        self.source = source
+        self.buffer = bytearray()
+        self.finished = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.finished and (size is None or size < 0 or len(self.buffer) < size):
+            chunk = self.source.read(COMPRESSION_CHUNK_SIZE)
+            if chunk:
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.finished = True
+
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_body(object_: Dict, compression: str = None):
+    """Readable stream with the body to upload, compressed if `compression` is set."""
+    stream = open(object_['file_path'], 'rb') if is_spooled(object_) else body_stream(object_body(object_))
+    if compression:
+        return CompressedStream(stream, compression)
+    return stream
+
+
+def read_body(object_: Dict) -> bytes:
+    if is_spooled(object_):
+        with open(object_['file_path'], 'rb') as f:
+            return f.read()
+    return object_body(object_)
+
+
+def write_bundle(members: List[tuple], pack_format: str) -> bytes:
+    """
+    Writes (member name, body) pairs as one bundle. JSONL lines and Parquet
+    rows have file_name/file_content columns; in JSONL, bodies that are not
+    UTF-8 text are base64 encoded and flagged with "encoding": "base64".
+    """
+    buffer = BytesIO()
+
+    if pack_format == 'jsonl':
+        for name, body in members:
+            try:
+                line = {'file_name': name, 'file_content': body.decode('utf-8')}
+            except UnicodeDecodeError:
+                line = {'file_name': name, 'file_content': base64.b64encode(body).decode('ascii'), 'encoding': 'base64'}
+            buffer.write(json.dumps(line).encode('utf-8') + b'\n')
+
+    elif pack_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.table({
+            'file_name': pa.array([name for name, _ in members], pa.string()),
+            'file_content': pa.array([bytes(body) for _, body in members], pa.binary())
+        })
+        pq.write_table(table, buffer, compression='zstd')
+
+    elif pack_format == 'tar':
+        with tarfile.open(fileobj=buffer, mode='w') as tar:
+            for name, body in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(body)
+                tar.addfile(info, body_stream(body))
 
-    failed_uploads = []
+    else:
+        raise ValueError(f"pack_format must be one of {PACK_FORMATS}, got '{pack_format}'")
+
+    return buffer.getvalue()
+
+
+def pack_objects(objects: Iterable[Dict], file_extension: str, pack_format: str,
+                 bundle_size_mb: int = BUNDLE_SIZE_MB, key_suffix: str = '') -> Iterator[Dict]:
+    """
+    Groups the objects into bundles of up to bundle_size_mb of contents plus an
+    index object mapping every file_name to its bundle and position. Bundles
+    (bundle_<hash>.jsonl, ...) and the index (_index_<hash>.json) are named
+    after a hash of their content: batches sent to the same prefix never
+    overwrite each other, while re-running the same batch rewrites (or, with
+    skip_unchanged, skips) the same keys. Bundles are yielded as soon as they
+    are full, the index last.
+    key_suffix (e.g. '.gz' with compression) is appended to the bundle names
+    written in the index, so they match the keys the bundles are uploaded to.
+    """
+    bundle_size = bundle_size_mb * 1024 * 1024
+    bundles, objects_count, index = 0, 0, []
+    members, members_size = [], 0
+
+    def bundle():
+        content = write_bundle(members, pack_format)
+        bundle_name = f"bundle_{content_hash(content)}.{pack_format}"
+        for position, (name, _) in enumerate(members):
+            index.append({'file_name': name, 'bundle': f"{bundle_name}{key_suffix}", 'position': position})
+        logger.debug(f'Packed {len(members)} objects in {bundle_name}')
+        return {'file_name': bundle_name, 'file_content': content}
 
-    logger.info(f'There are {len(objects)} to be uploaded')
     for object_ in objects:
+        body = read_body(object_)
+        if members and members_size + len(body) > bundle_size:
+            yield bundle()
+            bundles += 1
+            members, members_size = [], 0
+
+        name = f"{object_['file_name']}.{file_extension}" if file_extension is not None else object_['file_name']
+        members.append((name, body))
+        members_size += len(body)
+        objects_count += 1
+
+    if members:
+        yield bundle()
+        bundles += 1
+
+    logger.info(f'Packed {objects_count} objects in {bundles} {pack_format} bundles')
+    index_content = json.dumps(index)
+    yield {'file_name': f"{INDEX_FILE_PREFIX}{content_hash(index_content)}.json", 'file_content': index_content}
+
+
+def read_input_files(input_filepaths: List[str], input_format: str = 'json') -> Iterator[Dict]:
+    """
+    Reads the from_filepath input lazily, one object at a time: a json file is
+    one object (its name and parsed content), an ndjson file holds one object
+    or manifest entry (file_name, file_path) per line, and a raw file becomes a
+    manifest entry, so it is uploaded straight from disk.
+    """
+    if input_format not in INPUT_FORMATS:
+        raise ValueError(f"input_format must be one of {INPUT_FORMATS}, got '{input_format}'")
+
+    for input_filepath in input_filepaths:
+        if input_format == 'raw':
+            yield {'file_name': os.path.basename(input_filepath), 'file_path': input_filepath}
+
+        elif input_format == 'ndjson':
+            with open(input_filepath) as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
 
-        if file_extension is not None:
-            key = f"{prefix}/{object_['file_name']}.{file_extension}"
         else:
-            key = f"{prefix}/{object_['file_name']}"
-        logger.debug(f'Putting object {key} in s3')
-
-
-        if isinstance(object_['file_content'], str):
-            object_['file_content'] = object_['file_content'].encode('utf-8')
-
-        if isinstance(object_['file_content'], dict):
-            object_['file_content'] = json.dumps(object_['file_content']).encode('utf-8')
-
-        response = client.put_object(
-            Bucket=bucket_name,
-            Key=key,
-            Body=object_['file_content']
-        )
+            with open(input_filepath) as f:
+                file_content = json.loads(f.read())
+            yield {
+                "file_name": input_filepath,
+                "file_content": file_content
+            }
+
+
+def s3_etag(stream, transfer_config: TransferConfig) -> str:
+    """
+    ETag S3 assigns to a body uploaded with transfer_config: its MD5, or for
+    multipart uploads the MD5 of the parts' MD5s followed by the part count.
+    As the transfer manager does for streams of unknown size, a body is only
+    uploaded in parts if it reaches the multipart threshold.
+    """
+    head = stream.read(transfer_config.multipart_threshold)
+    if len(head) < transfer_config.multipart_threshold:
+        return hashlib.md5(head).hexdigest()
+
+    digests = []
+    part = head
+    while part:
+        while len(part) >= transfer_config.multipart_chunksize:
+            digests.append(hashlib.md5(part[:transfer_config.multipart_chunksize]).digest())
+            part = part[transfer_config.multipart_chunksize:]
+        chunk = stream.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        part += chunk
+    if part:
+        digests.append(hashlib.md5(part).digest())
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def object_etag(object_: Dict, transfer_config: TransferConfig, compression: str = None) -> str:
+    stream = open_body(object_, compression)
+    try:
+        return s3_etag(stream, transfer_config)
+    finally:
+        stream.close()
+
+
+def list_etags(client, bucket_name: str, prefix: str) -> Dict[str, str]:
+    """ETags of every object under the prefix, from one paginated listing."""
+    etags = {}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+        for object_metadata in page.get('Contents', []):
+            etags[object_metadata['Key']] = object_metadata['ETag'].strip('"')
+    return etags
+
+
+def upload_object(client, object_: Dict, bucket_name: str, key: str, transfer_config: TransferConfig,
+                  compression: str = None) -> None:
+    """
+    Uploads one object through the transfer manager: bodies above the multipart
+    threshold are sent as concurrent parts. With compression, the body is
+    compressed as the parts are read and stored with its ContentEncoding.
+    """
+    logger.debug(f'Putting object {key} in s3')
+
+    if compression:
+        with open_body(object_, compression) as stream:
+            client.upload_fileobj(stream, bucket_name, key, ExtraArgs={'ContentEncoding': compression},
+                                  Config=transfer_config)
+        return
+
+    if is_spooled(object_):
+        client.upload_file(object_['file_path'], bucket_name, key, Config=transfer_config)
+        return
+
+    client.upload_fileobj(body_stream(object_body(object_)), bucket_name, key, Config=transfer_config)
 
 
-        if response['ResponseMetadata']['HTTPStatusCode'] != 200:
-            failed_uploads.append({'object_metadata': object_['file_name'], 'boto_response': response['ResponseMetadata']})
+def put_objects_in_s3(
+    objects: Iterable[Dict],
+    bucket_name: str,
+    prefix: str,
+    file_extension: str,
+    max_workers: int = 1,
+    max_concurrency: int = MAX_CONCURRENCY,
+    multipart_threshold_mb: int = MULTIPART_THRESHOLD_MB,
+    multipart_chunksize_mb: int = MULTIPART_CHUNKSIZE_MB,
+    skip_unchanged: bool = False,
+    pack_format: str = None,
+    bundle_size_mb: int = BUNDLE_SIZE_MB,
+    compression: str = None,
+    max_inflight_mb: int = MAX_INFLIGHT_MB
+) -> Union[Dict[str, str], None]:
+    """
+    Uploads the objects with up to `max_workers` objects in flight. Each object
+    goes through the boto3 transfer manager, which splits bodies above
+    `multipart_threshold_mb` into `multipart_chunksize_mb` parts uploaded
+    `max_concurrency` at a time. Failed objects are collected and reported
+    together at the end.
+    With skip_unchanged, the prefix is listed once and objects whose content
+    hashes to the ETag already at their key are not uploaded again. ETags only
+    match for objects uploaded with the same multipart settings and without
+    SSE-KMS; anything else is simply uploaded.
+    With pack_format (jsonl, parquet or tar), the objects are uploaded as
+    size-bounded bundles plus an index instead of one object each (see
+    pack_objects).
+    Objects may come from any iterable (see read_input_files): at most
+    2 * max_workers of them, holding at most max_inflight_mb of in-memory
+    bodies (bundles included), are taken ahead of the uploads, so reading the
+    input overlaps with uploading and memory does not grow with the total. A
+    single body larger than the cap is still uploaded, alone.
+    With compression (gzip or zstd), bodies are compressed while they are
+    uploaded, stored with ContentEncoding and their keys get a .gz/.zst suffix.
+    """
+    if compression and compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError(f"compression must be one of {list(COMPRESSION_EXTENSIONS)}, got '{compression}'")
+    key_suffix = f".{COMPRESSION_EXTENSIONS[compression]}" if compression else ''
+
+    if pack_format:
+        objects = pack_objects(objects, file_extension, pack_format, bundle_size_mb, key_suffix)
+        file_extension = None
+
+    max_workers = max(1, max_workers)
+    transfer_config = TransferConfig(
+        multipart_threshold=multipart_threshold_mb * 1024 * 1024,
+        multipart_chunksize=multipart_chunksize_mb * 1024 * 1024,
+        max_concurrency=max_concurrency
+    )
+    client = boto3.client(
+        's3',
+        region_name='us-east-1',
+        config=Config(max_pool_connections=max(10, max_workers * max_concurrency))
+    )
 
+    failed_uploads = []
+    skipped = []
+    existing_etags = list_etags(client, bucket_name, f"{prefix}/") if skip_unchanged else {}
+
+    def upload(object_):
+        key = f"{object_key(object_, prefix, file_extension)}{key_suffix}"
+        try:
+            if key in existing_etags and object_etag(object_, transfer_config, compression) == existing_etags[key]:
+                skipped.append(key)
+                return
+            upload_object(client, object_, bucket_name, key, transfer_config, compression)
+        except Exception as e:
+            failed_uploads.append({'object_metadata': object_['file_name'], 'error': str(e)})
+
+    processed = 0
+    max_inflight_bytes = max_inflight_mb * 1024 * 1024
+    inflight_bytes = 0
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for object_ in objects:
+            size = inflight_size(object_)
+
+            # Waits for the oldest uploads until the new object fits in the caps
+            while pending and (len(pending) >= 2 * max_workers or inflight_bytes + size > max_inflight_bytes):
+                future, pending_size = pending.popleft()
+                future.result()
+                inflight_bytes -= pending_size
+
+            pending.append((executor.submit(upload, object_), size))
+            inflight_bytes += size
+            processed += 1
+        while pending:
+            pending.popleft()[0].result()
+    logger.info(f'{processed} objects were processed')
+
+    if skip_unchanged:
+        logger.info(f'{len(skipped)} objects were unchanged and were not uploaded again')
 
     if len(failed_uploads) > 0:
         raise Exception(f"Failed to upload the following files: \n{failed_uploads}")
@@ -60,6 +453,7 @@ def orchest_handler():
     prefix = orchest.get_step_param('prefix')
     file_extension = orchest.get_step_param('file_extension')
     input_type = orchest.get_step_param('input_type')
+    input_format = orchest.get_step_param('input_format') or 'json'
 
 
     if prefix is None:
@@ -67,15 +461,7 @@ def orchest_handler():
 
     if input_type == "from_filepath":
         input_filepaths = orchest.get_step_param("input_filepaths")
-
-        objects = []
-        for input_filepath in input_filepaths:
-            with open(input_filepath) as f:
-                file_content = json.loads(f.read())
-            objects.append({
-                "file_name": input_filepath,
-                "file_content": file_content
-            })
+        objects = read_input_files(input_filepaths, input_format)
 
     elif input_type == "from_incoming_variable":
         incoming_variable_name = orchest.get_step_param("incoming_variable_name")
@@ -85,7 +471,16 @@ def orchest_handler():
         objects=objects,
         bucket_name=bucket_name,
         prefix=prefix,
-        file_extension=file_extension
+        file_extension=file_extension,
+        max_workers=orchest.get_step_param('max_workers') or 1,
+        max_concurrency=orchest.get_step_param('max_concurrency') or MAX_CONCURRENCY,
+        multipart_threshold_mb=orchest.get_step_param('multipart_threshold_mb') or MULTIPART_THRESHOLD_MB,
+        multipart_chunksize_mb=orchest.get_step_param('multipart_chunksize_mb') or MULTIPART_CHUNKSIZE_MB,
+        skip_unchanged=bool(orchest.get_step_param('skip_unchanged')),
+        pack_format=orchest.get_step_param('pack_format'),
+        bundle_size_mb=orchest.get_step_param('bundle_size_mb') or BUNDLE_SIZE_MB,
+        compression=orchest.get_step_param('compression'),
+        max_inflight_mb=orchest.get_step_param('max_inflight_mb') or MAX_INFLIGHT_MB
     )
 
 def script_handler():
@@ -94,7 +489,7 @@ def script_handler():
     config_json = sys.argv[1]
     config = json.loads(config_json)
 
-    input_filepath = config['input_filepath']
+    input_format = config.get('input_format', 'json')
     bucket_name = config['bucket_name']
     prefix = config.get('prefix')
 
@@ -103,14 +498,26 @@ def script_handler():
 
     file_extension = config.get('file_extension')
 
-    with open(input_filepath,'r') as f:
-        objects = json.load(f)
+    if input_format == 'json':
+        with open(config['input_filepath'],'r') as f:
+            objects = json.load(f)
+    else:
+        objects = read_input_files(config.get('input_filepaths') or [config['input_filepath']], input_format)
 
     put_objects_in_s3(
         objects=objects,
         bucket_name=bucket_name,
         prefix=prefix,
-        file_extension=file_extension
+        file_extension=file_extension,
+        max_workers=config.get('max_workers', 1),
+        max_concurrency=config.get('max_concurrency', MAX_CONCURRENCY),
+        multipart_threshold_mb=config.get('multipart_threshold_mb', MULTIPART_THRESHOLD_MB),
+        multipart_chunksize_mb=config.get('multipart_chunksize_mb', MULTIPART_CHUNKSIZE_MB),
+        skip_unchanged=config.get('skip_unchanged', False),
+        pack_format=config.get('pack_format'),
+        bundle_size_mb=config.get('bundle_size_mb', BUNDLE_SIZE_MB),
+        compression=config.get('compression'),
+        max_inflight_mb=config.get('max_inflight_mb', MAX_INFLIGHT_MB)
     )
 
 if __name__ == "__main__":
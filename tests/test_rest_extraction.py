@@ -0,0 +1,188 @@
+import os
+import sys
+import time
+import bisect
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+STEPS_DIR = os.path.join(os.path.dirname(__file__), "..", "steps")
+# Steps are deployed independently, so each one keeps its own copy of the engine
+ENGINE_COPIES = [
+    os.path.join(STEPS_DIR, "get_data_from_c2s", "rest_extraction.py"),
+    os.path.join(STEPS_DIR, "get_data_from_sponte", "rest_extraction.py"),
+]
+
+sys.path.insert(0, os.path.join(STEPS_DIR, "get_data_from_sponte"))
+
+import rest_extraction  # noqa: E402
+from rest_extraction import RestExtractor, TokenBucket, get_http_session  # noqa: E402
+
+
+def test_engine_copies_are_identical():
+    contents = []
+    for path in ENGINE_COPIES:
+        assert not os.path.islink(path), f"{path} must be a regular file"
+        with open(path, "rb") as f:
+            contents.append(f.read())
+    assert all(content == contents[0] for content in contents), "rest_extraction.py copies differ"
+
+
+def max_in_window(timestamps, window):
+    """Largest number of timestamps inside any `window` seconds interval."""
+    timestamps = sorted(timestamps)
+    return max(bisect.bisect_left(timestamps, t + window) - i for i, t in enumerate(timestamps))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        # Float rounding can leave a wait of ~1e-15s, which would never move the clock
+        self.now += max(seconds, 1e-6)
+
+
+@pytest.mark.parametrize("max_per_minute, capacity", [(1000, 10), (10, 1)])
+def test_token_bucket_never_exceeds_the_limit_in_a_minute(monkeypatch, max_per_minute, capacity):
+    clock = FakeClock()
+    monkeypatch.setattr(rest_extraction.time, "time", clock.time)
+    monkeypatch.setattr(rest_extraction.time, "sleep", clock.sleep)
+
+    bucket = TokenBucket(max_per_minute - capacity, capacity=capacity)
+    requests_at = []
+    for _ in range(max_per_minute * 3):
+        bucket.acquire()
+        bucket.on_success()
+        requests_at.append(clock.now)
+
+    assert max_in_window(requests_at, 60) <= max_per_minute
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keeps the connection open between requests, as the real APIs do. Without
+    # Nagle, the separate header and body writes are not held for a delayed ACK
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.arrivals.append(self.server.clock())
+        self.server.connections.add(self.client_address)
+        body = b'{"items": []}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.arrivals = []
+    server.connections = set()
+    server.clock = time.monotonic
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def call_api(url, state_path, rate_per_minute, capacity, requests_per_process):
+    bucket = TokenBucket(rate_per_minute, capacity=capacity, state_path=state_path)
+    extractor = RestExtractor(rate_limiter=bucket)
+    for _ in range(requests_per_process):
+        extractor.request(url)
+
+
+def test_processes_share_one_quota_through_the_state_file(stub_server, tmp_path):
+    # Short window: 1200 req/min is 20 req/s, so the test takes a few seconds
+    max_per_minute, capacity = 1200, 5
+    rate_per_second = (max_per_minute - capacity) / 60
+    processes_count, requests_per_process = 4, 20
+    url = f"http://127.0.0.1:{stub_server.server_port}/"
+
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=call_api, args=(url, str(tmp_path / "quota.json"), max_per_minute - capacity,
+                                               capacity, requests_per_process))
+        for _ in range(processes_count)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    arrivals = stub_server.arrivals
+    total = processes_count * requests_per_process
+    assert len(arrivals) == total
+    # Separate buckets would let 4x the quota through: the aggregate must follow a single bucket
+    assert max(arrivals) - min(arrivals) >= (total - capacity) / rate_per_second * 0.95
+    # Two requests of slack for the varying latency between acquire() and the arrival
+    assert max_in_window(arrivals, 2.0) <= capacity + rate_per_second * 2 + 2
+
+
+def latency_per_page(get, url, pages):
+    started = time.perf_counter()
+    for _ in range(pages):
+        get(url).raise_for_status()
+    return (time.perf_counter() - started) / pages
+
+
+def test_pooled_session_reuses_connections_and_lowers_latency_per_page(stub_server):
+    url = f"http://127.0.0.1:{stub_server.server_port}/"
+    pages = 200
+
+    unpooled = latency_per_page(requests.get, url, pages)
+    unpooled_connections = len(stub_server.connections)
+
+    stub_server.connections.clear()
+    with get_http_session() as session:
+        pooled = latency_per_page(session.get, url, pages)
+    pooled_connections = len(stub_server.connections)
+
+    print(f"latency per page: requests.get {unpooled * 1000:.3f} ms, pooled session {pooled * 1000:.3f} ms")
+    assert unpooled_connections == pages
+    assert pooled_connections == 1
+    assert pooled < unpooled
+
+
+def test_one_active_process_uses_the_quota_of_idle_siblings(stub_server, tmp_path):
+    # The quota is sized for 4 steps, but only one of them has requests to make
+    max_per_minute, capacity, steps_count = 1200, 5, 4
+    rate_per_second = (max_per_minute - capacity) / 60
+    # Before the shared bucket, each step got a fixed floor(limit / count_of_steps)
+    old_slice_per_second = (max_per_minute // steps_count) / 60
+    requests_count = 60
+    url = f"http://127.0.0.1:{stub_server.server_port}/"
+    state_path = str(tmp_path / "quota.json")
+
+    # The idle siblings share the state file but make no requests
+    for _ in range(steps_count - 1):
+        TokenBucket(max_per_minute - capacity, capacity=capacity, state_path=state_path)
+
+    process = multiprocessing.get_context("fork").Process(
+        target=call_api, args=(url, state_path, max_per_minute - capacity, capacity, requests_count)
+    )
+    process.start()
+    process.join(timeout=60)
+    assert process.exitcode == 0
+
+    arrivals = sorted(stub_server.arrivals)
+    assert len(arrivals) == requests_count
+    # The initial burst is left out, so only the refill rate is measured
+    rate = (requests_count - capacity) / (arrivals[-1] - arrivals[0])
+    print(f"one active step: {rate:.1f} req/s, old slice {old_slice_per_second:.1f} req/s")
+    assert rate > 2 * old_slice_per_second
+    assert rate >= 0.8 * rate_per_second